@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  entries_id_range.py
+#
+#  Gabriele Iannetti <g.iannetti@gsi.de>
+
+
+def iter_id_ranges( cur, chunk_size, table = 'ENTRIES' ):
+   """Yields ( start_id, end_id ) tuples covering the primary key of a table in ranges of chunk_size rows.
+
+   The start_id is inclusive, the end_id is exclusive and None for the last range.
+   Each boundary is found by reading chunk_size keys of the primary key index from the previous boundary on.
+   """
+
+   if chunk_size < 1:
+      raise RuntimeError( 'Chunk size must be a positive number!' )
+
+   cur.execute( "SELECT MIN(id) FROM " + table )
+
+   start_id = cur.fetchone()[ 0 ]
+
+   while start_id is not None:
+
+      cur.execute( "SELECT id FROM " + table + " WHERE id >= %s ORDER BY id LIMIT 1 OFFSET %s", ( start_id, chunk_size ) )
+
+      row = cur.fetchone()
+
+      end_id = None
+
+      if row:
+         end_id = row[ 0 ]
+
+      yield start_id, end_id
+
+      start_id = end_id
+
+
+def get_id_range_condition( start_id, end_id, column = 'id' ):
+   """Returns the SQL condition and its parameters for an id range from iter_id_ranges()."""
+
+   if end_id is None:
+      return column + " >= %s", ( start_id, )
+
+   return column + " >= %s AND " + column + " < %s", ( start_id, end_id )
+
+
+def get_estimated_row_count( cur, table = 'ENTRIES' ):
+   """Returns the number of rows of a table from the table statistics of the current database.
+
+   The number is exact for MyISAM, but only an estimation for InnoDB.
+   """
+
+   cur.execute( "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", ( table, ) )
+
+   row = cur.fetchone()
+
+   if not row or row[ 0 ] is None:
+      return 0
+
+   return int( row[ 0 ] )
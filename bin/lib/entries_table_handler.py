@@ -6,29 +6,148 @@
 #  Gabriele Iannetti <g.iannetti@gsi.de>
 
 
-class EntryInfo:
+import array
+import sys
+import zlib
+
+
+def decode_column( value ):
+   
+   # The Robinhood tables store uids and names as varbinary columns.
+   if isinstance( value, bytes ):
+      return value.decode( errors='replace' )
+   
+   return value
+
+
+def split_rows_by_uid_shard( rows, num_shards ):
+   """Partitions rows of (fid, uid, size) by a hash of the uid, so each shard gets all files of its users.
+   
+   The order of the rows is kept within each shard.
+   """
+   
+   shard_rows_list = [ list() for shard in range( num_shards ) ]
+   
+   for row in rows:
+      
+      uid = row[ 1 ]
+      
+      if not isinstance( uid, bytes ):
+         uid = uid.encode()
+      
+      shard_rows_list[ zlib.crc32( uid ) % num_shards ].append( row )
+   
+   return shard_rows_list
+
+
+class StringColumn:
+   """Column of strings kept UTF-8 encoded in one buffer with an offset per string, instead of one string object per entry."""
+   
+   def __init__( self ):
+      
+      self.buffer       = bytearray()
+      self.offset_array = array.array( 'q', [ 0 ] )
+   
+   def __len__( self ):
+      return len( self.offset_array ) - 1
+   
+   def __getitem__( self, index ):
+      return self.buffer[ self.offset_array[ index ] : self.offset_array[ index + 1 ] ].decode()
+   
+   def append( self, value ):
+      
+      self.buffer += value.encode()
+      self.offset_array.append( len( self.buffer ) )
+
+
+class EntryInfoStore:
+   """Column oriented store of large file entries grouped by uid.
+   
+   Each uid is interned and kept once together with the index range of its entries.
+   Each directory path is kept once, a file path is stored as directory index and file name.
+   Fids and file names are kept encoded in string columns.
+   """
+   
+   def __init__( self ):
+      
+      self.fid_column      = StringColumn()
+      self.size_array      = array.array( 'q' )
+      self.dir_index_array = array.array( 'l' )
+      self.name_column     = StringColumn()
+      self.dir_path_list   = list()
+      self.uid_range_map   = dict()
+   
+   def __len__( self ):
+      return len( self.fid_column )
+   
+   def append( self, fid, uid, size, dir_index, name ):
+      """Appends an entry, the entries of an uid are expected to be appended one after another.
+      
+      An entry without a file name is stored with an empty name and gets the directory path as path.
+      """
+      
+      index = len( self.fid_column )
+      
+      if uid in self.uid_range_map:
+         
+         start, end = self.uid_range_map[ uid ]
+         
+         self.uid_range_map[ uid ] = ( start, index + 1 )
+      
+      else:
+         self.uid_range_map[ sys.intern( uid ) ] = ( index, index + 1 )
+      
+      self.fid_column.append( fid )
+      self.size_array.append( size )
+      self.dir_index_array.append( dir_index )
+      self.name_column.append( name or '' )
+   
+   def add_dir_path( self, dir_path ):
+      
+      self.dir_path_list.append( dir_path )
+      
+      return len( self.dir_path_list ) - 1
+   
+   def get_uid_list( self ):
+      return list( self.uid_range_map.keys() )
+   
+   def iter_index( self, uid ):
+      
+      start, end = self.uid_range_map[ uid ]
+      
+      return range( start, end )
+   
+   def get_fid( self, index ):
+      return self.fid_column[ index ]
    
-   def __init__( self, fid, uid, size, path ):
+   def get_size( self, index ):
+      return self.size_array[ index ]
+   
+   def get_path( self, index ):
+      
+      dir_path = self.dir_path_list[ self.dir_index_array[ index ] ]
+      name     = self.name_column[ index ]
+      
+      if not name:
+         return dir_path
       
-      self.fid  = fid
-      self.uid  = uid
-      self.size = size
-      self.path = path
+      return dir_path + "/" + name
 
 
 class EntriesTableHandler:
 
    def __init__( self, cur, logger, db, threshold, file_system ):
       
-      self.cur         = cur
-      self.logger      = logger
-      self.db          = db
-      self.threshold   = threshold
-      self.file_system = file_system
-      self.fid_map     = dict()
+      self.cur           = cur
+      self.logger        = logger
+      self.db            = db
+      self.threshold     = threshold
+      self.file_system   = file_system
+      self.fid_map       = dict()
+      self.dir_index_map = dict()
    
    
-   def get_entry_info_map( self ):
+   def get_large_file_rows( self ):
    
       sql = "SELECT id, uid, size FROM " + self.db + "." + "ENTRIES WHERE size >= " + str( self.threshold ) + " ORDER BY uid ASC;"
       
@@ -38,43 +157,82 @@ class EntriesTableHandler:
       self.logger.info( "Found number of large files: " + str( self.cur.rowcount ) )
       
       if not self.cur.rowcount:
-         return dict()
+         return list()
+      
+      return list( self.cur.fetchall() )
+   
+   
+   def get_entry_info_store( self, rows ):
+      """Transfers rows of (fid, uid, size) into an entry info store, resolving the file paths.
       
-      file_entries_map = dict()
+      The rows are sorted by their decoded uid in place and released from the list as they are transferred.
+      """
       
-      for row in self.cur.fetchall():
+      entry_info_store = EntryInfoStore()
+      
+      # Grouped here instead of relying on the ORDER BY of the query, which compares the undecoded column.
+      rows.sort( key=lambda row : decode_column( row[ 1 ] ) )
+      
+      for i in range( len( rows ) ):
          
-         uid = row[ 1 ]
+         fid, uid, size = rows[ i ]
          
-         if uid in file_entries_map:
-            
-            file_path = self.get_file_path( row[ 0 ] )
-            
-            file_entries_map[ uid ].append( EntryInfo( row[ 0 ], row[ 1 ], row[ 2 ], file_path ) )
-            
-            self.logger.debug( "Appended entry info item into dict for UID: %s", uid )
-            self.logger.debug( "Count of items for UID: %s", len( file_entries_map[ uid ] ) )
-            
-         else:
-            
-            file_entries_list = list()
-            
-            file_path = self.get_file_path( row[ 0 ] )
-            
-            file_entries_list.append( EntryInfo( row[ 0 ], row[ 1 ], row[ 2 ], file_path ) )
-            
-            file_entries_map[ uid ] = file_entries_list            
-            
-            self.logger.debug( "Created new list in dict for UID: %s", uid )
+         # Rows are released as soon as they are transferred into the store.
+         rows[ i ] = None
+         
+         dir_index, name = self.get_dir_index_and_name( entry_info_store, fid )
+         
+         entry_info_store.append( decode_column( fid ), decode_column( uid ), size, dir_index, name )
       
-      return file_entries_map
-
-
-   def get_file_path( self, fid ):
+      self.logger.debug( "Stored %d entries of %d users in %d directories.", len( entry_info_store ), len( entry_info_store.uid_range_map ), len( entry_info_store.dir_path_list ) )
+      
+      return entry_info_store
+   
+   
+   def get_dir_index_and_name( self, entry_info_store, fid ):
+      
+      result = self.get_names_row( fid )
+      
+      if not result or not ( result[ 0 ] and result[ 1 ] ):
+         return self.get_dir_index( entry_info_store, None ), None
+      
+      pid, name = result
+      
+      return self.get_dir_index( entry_info_store, pid ), name
+   
+   
+   def get_dir_index( self, entry_info_store, pid ):
+      
+      if pid in self.dir_index_map:
+         return self.dir_index_map[ pid ]
+      
+      if pid is None:
+         dir_path = self.file_system
+      else:
+         dir_path = self.file_system + self.get_name_item_by_parent_fid( pid )
       
-      return self.file_system + self.get_name_item_by_parent_fid( fid )
+      dir_index = entry_info_store.add_dir_path( dir_path )
+      
+      self.dir_index_map[ pid ] = dir_index
+      
+      return dir_index
    
    
+   def get_names_row( self, fid ):
+      
+      sql = "SELECT parent_id, name FROM " + self.db + "." + "NAMES WHERE id = %s"
+      
+      self.cur.execute( sql, ( fid, ) )
+      self.logger.debug( sql )
+      
+      result = self.cur.fetchone()
+      
+      if result:
+         return result[ 0 ], decode_column( result[ 1 ] )
+      
+      return None
+
+
    def get_name_item_by_parent_fid( self, fid ):
       
       pid  = None
@@ -88,17 +246,12 @@ class EntriesTableHandler:
          name = value_tuple[ 1 ]
       
       else:
-         sql = "SELECT parent_id, name FROM " + self.db + "." + "NAMES WHERE id = '" + fid + "'"
-         
-         self.cur.execute( sql )
-         self.logger.debug( sql )
          
-         result = self.cur.fetchone()
+         result = self.get_names_row( fid )
          
          if result:
             
-            pid  = result[ 0 ]
-            name = result[ 1 ]
+            pid, name = result
             
             self.fid_map[ fid ] = tuple( ( pid, name ) )
       
@@ -112,3 +265,4 @@ class EntriesTableHandler:
    def reset_fid_map( self ):
       
       self.fid_map.clear()
+      self.dir_index_map.clear()
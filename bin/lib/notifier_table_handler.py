@@ -6,19 +6,38 @@
 #  Gabriele Iannetti <g.iannetti@gsi.de>
 
 
+import time
+
+from lib.entries_table_handler import decode_column
+
+
 GB_DIV_DB=1000000000
 TB_DIV_DB=1000000000000
 
+# Maximum number of rows sent to the database within one statement.
+BATCH_SIZE=1000
+
+# Maximum number of rows deleted within one statement on purging old entries.
+PURGE_BATCH_SIZE=10000
+
+# Seconds paused between two purge batches, so a large purge is spread out instead of one write burst.
+PURGE_PAUSE=0.1
+
+ENGINE='MyISAM'
+SUPPORTED_ENGINES=[ 'MyISAM', 'InnoDB' ]
+
+LAST_CHECK_INDEX='last_check_idx'
+
 
 def convert_number_human_readable( number ):
    
    number_human_readable = None
       
    if number >= GB_DIV_DB and number < TB_DIV_DB:
-      number_human_readable = str ( number / GB_DIV_DB ) + "GB"
+      number_human_readable = str ( number // GB_DIV_DB ) + "GB"
    
-   elif number > TB_DIV_DB:
-      number_human_readable = str( number / TB_DIV_DB ) + "TB"
+   elif number >= TB_DIV_DB:
+      number_human_readable = str( number // TB_DIV_DB ) + "TB"
    
    else:
       raise RuntimeError( 'Number convertion not supported!' )
@@ -26,49 +45,53 @@ def convert_number_human_readable( number ):
    return number_human_readable
 
 
-class NotifyInfo:
-   
-   def __init__( self, fid, uid, size, path, last_check, last_notify = 'NULL', ignore_notify = 'FALSE' ):
-         
-         self.fid           = fid
-         self.uid           = uid
-         self.size          = size
-         self.path          = path
-         self.last_check    = last_check
-         self.last_notify   = last_notify
-         self.ignore_notify = ignore_notify
-
-   def to_sql_values(self):
-
-      sql_values = "'" + self.fid + "', '" + self.uid + "', " + str( self.size ) + ", '" + self.path + "', '" + self.last_check + "', "
-
-      if self.last_notify == 'NULL':
-         sql_values += self.last_notify
-      else:
-         sql_values += "'" + self.last_notify + "'"
-
-      sql_values += ", '" + self.ignore_notify + "'"
-
-      return sql_values
+def export_compact_to_csv( size, path ):
+   return convert_number_human_readable( size ) + ";" + path + "\n"
 
-   def export_compact_to_csv( self ):
-      return convert_number_human_readable( self.size ) + ";" + self.path + "\n"
 
-   def export_full_to_csv( self ):
-      return self.uid + ";" + convert_number_human_readable( self.size ) + ";" + self.path + ";" + self.last_notify + "\n"
+def export_full_to_csv( uid, size, path, last_notify ):
+   return uid + ";" + convert_number_human_readable( size ) + ";" + path + ";" + str( last_notify ) + "\n"
 
 
 class NotifierTableHandler:
 
-   def __init__( self, cur, logger, table, db ):
+   def __init__( self, cur, logger, table, db, batch_size = BATCH_SIZE, purge_batch_size = PURGE_BATCH_SIZE, engine = ENGINE, purge_pause = PURGE_PAUSE ):
+      
+      if batch_size < 1 or purge_batch_size < 1:
+         raise RuntimeError( 'Batch size must be a positive number!' )
       
-      self.cur    = cur
-      self.logger = logger
-      self.table  = table
-      self.db     = db
+      if purge_pause < 0:
+         raise RuntimeError( 'Purge pause must not be negative!' )
+      
+      if engine not in SUPPORTED_ENGINES:
+         raise RuntimeError( "Not supported storage engine: " + engine )
+      
+      self.cur              = cur
+      self.logger           = logger
+      self.table            = table
+      self.db               = db
+      self.batch_size       = batch_size
+      self.purge_batch_size = purge_batch_size
+      self.engine           = engine
+      self.purge_pause      = purge_pause
       
       self.new_notify_queue    = list()
       self.update_notify_queue = list()
+      self.last_check_queue    = dict()
+   
+   def _execute_batched( self, sql, params_list ):
+      
+      self.logger.debug( sql )
+      
+      for i in range( 0, len( params_list ), self.batch_size ):
+         
+         batch = params_list[ i : i + self.batch_size ]
+         
+         start_time = time.time()
+         
+         self.cur.executemany( sql, batch )
+         
+         self.logger.debug( "Executed batch of %d rows in %.3f seconds.", len( batch ), time.time() - start_time )
    
    def create_notifier_table( self ):
       
@@ -86,13 +109,49 @@ path varchar(1000)                  NOT NULL,
 last_check DATETIME                 NOT NULL,
 last_notify DATETIME                DEFAULT NULL,
 ignore_notify ENUM('FALSE', 'TRUE') DEFAULT 'FALSE',
-PRIMARY KEY (fid)
-) ENGINE=MyISAM DEFAULT CHARSET=latin1;
+PRIMARY KEY (fid),
+INDEX """ + LAST_CHECK_INDEX + """ (last_check)
+) ENGINE=""" + self.engine + """ DEFAULT CHARSET=latin1;
 """
       
       self.cur.execute( sql )
       self.logger.debug( "Created table:\n" + sql )
 
+   def migrate_notifier_table( self ):
+      
+      alter_list = list()
+      
+      sql = "SHOW INDEX FROM " + self.db + "." + self.table + " WHERE Key_name = %s"
+      
+      self.cur.execute( sql, ( LAST_CHECK_INDEX, ) )
+      self.logger.debug( sql )
+      
+      if not self.cur.fetchall():
+         alter_list.append( "ADD INDEX " + LAST_CHECK_INDEX + " (last_check)" )
+      
+      sql = "SELECT ENGINE FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s"
+      
+      self.cur.execute( sql, ( self.db, self.table ) )
+      self.logger.debug( sql )
+      
+      result = self.cur.fetchone()
+      
+      if not result:
+         raise RuntimeError( "Notifier table not found for migration: " + self.db + "." + self.table )
+      
+      if result[ 0 ] != self.engine:
+         alter_list.append( "ENGINE=" + self.engine )
+      
+      if not alter_list:
+         self.logger.info( "Notifier table is already up to date: " + self.db + "." + self.table )
+         return
+      
+      # A single ALTER TABLE, so the table is rebuilt only once.
+      sql = "ALTER TABLE " + self.db + "." + self.table + " " + ", ".join( alter_list )
+      
+      self.cur.execute( sql )
+      self.logger.info( "Migrated notifier table: " + sql )
+
    def is_table_empty( self ):
       
       sql = "SELECT 1 FROM " + self.db + "." + self.table + " LIMIT 1;"
@@ -112,91 +171,128 @@ PRIMARY KEY (fid)
       self.cur.execute( sql )
       self.logger.debug( sql )
 
-   def get_notify_item( self, fid ):
+   def get_notify_row_map( self, fid_list ):
+      """Returns a dict of fid to tuple of (uid, size, path, last_notify, ignore_notify) for the fids found in the notifier table.
       
-      sql = "SELECT fid, uid, size, path, last_check, last_notify, ignore_notify FROM " + self.db + "." + self.table + " WHERE fid = '" + fid + "'"
+      The fids are queried within one IN list per batch, last_notify is 'NULL' if not set.
+      """
       
-      self.cur.execute( sql )
-      self.logger.debug( sql )
+      notify_row_map = dict()
       
-      result = self.cur.fetchone()
+      sql = "SELECT fid, uid, size, path, last_notify, ignore_notify FROM " + self.db + "." + self.table + " WHERE fid IN (%s)"
       
-      if result:
-
-         fid           = result[ 0 ]
-         uid           = result[ 1 ]
-         size          = result[ 2 ]
-         path          = result[ 3 ]
-         last_check    = result[ 4 ]
-         last_notify   = result[ 5 ]
-         ignore_notify = result[ 6 ]
-
-         if last_notify is None:
-            last_notify = 'NULL'
-
-         return NotifyInfo( fid, uid, size, path, last_check, last_notify, ignore_notify )
+      self.logger.debug( sql )
       
-      return None
+      for i in range( 0, len( fid_list ), self.batch_size ):
+         
+         batch_fid_list = fid_list[ i : i + self.batch_size ]
+         
+         self.cur.execute( sql % ', '.join( [ '%s' ] * len( batch_fid_list ) ), batch_fid_list )
+         
+         for fid, uid, size, path, last_notify, ignore_notify in self.cur.fetchall():
+            
+            if last_notify is None:
+               last_notify = 'NULL'
+            
+            notify_row_map[ decode_column( fid ) ] = ( decode_column( uid ), size, decode_column( path ), last_notify, decode_column( ignore_notify ) )
+      
+      return notify_row_map
 
-   def insert_new_notify_info_list( self, new_notify_info_list ):
+   def insert_new_notify_list( self, new_notify_list ):
+      """Inserts new entries given as tuples of (fid, uid, size, path, last_check, last_notify), last_notify may be None."""
       
-      sql = "INSERT INTO " + self.db + "." + self.table + " VALUES "
+      sql = "INSERT INTO " + self.db + "." + self.table + " (fid, uid, size, path, last_check, last_notify) VALUES (%s, %s, %s, %s, %s, %s)"
       
-      sql += "(" + new_notify_info_list[ 0 ].to_sql_values() + ")"
+      self._execute_batched( sql, new_notify_list )
+
+   def update_last_notify( self, fid_list, last_notify ):
       
-      if len( new_notify_info_list ) > 1:
-         
-         for notify_info in new_notify_info_list[ 1: ]:
-            sql += ", (" + notify_info.to_sql_values() + ")"
+      sql = "UPDATE " + self.db + "." + self.table + " SET last_notify = %s WHERE fid IN (%s)"
       
       self.logger.debug( sql )
-      self.cur.execute( sql )
-
-   def update_last_notify( self, update_notify_info_list, last_notify ):
-      
-      sql = "UPDATE " + self.db + "." + self.table + " SET last_notify = '" + last_notify + "' WHERE fid IN ('" + update_notify_info_list[ 0 ].fid + "'"
       
-      if len( update_notify_info_list ) > 1:
+      # One statement per batch with a parameterized IN list instead of one statement per fid.
+      for i in range( 0, len( fid_list ), self.batch_size ):
          
-         for notify_info in update_notify_info_list[ 1: ]:
-            sql += ", '" + notify_info.fid + "'"
-      
-      sql += ")"
-      
-      self.logger.debug( sql )
-      self.cur.execute( sql )
+         batch_fid_list = fid_list[ i : i + self.batch_size ]
+         
+         start_time = time.time()
+         
+         self.cur.execute( sql % ( '%s', ', '.join( [ '%s' ] * len( batch_fid_list ) ) ), [ last_notify ] + batch_fid_list )
+         
+         self.logger.debug( "Executed batch of %d rows in %.3f seconds.", len( batch_fid_list ), time.time() - start_time )
 
-   def update_notify_item_on_last_check( self, notify_item, entry_info, check_timestamp ):
-   
-      sql_update_where_list = list()
+   def update_notify_item_on_last_check( self, notify_row, fid, uid, size, path, check_timestamp ):
+      """Queues the last_check update of an entry, notify_row is the tuple returned for the fid by get_notify_row_map."""
       
-      if notify_item.uid != entry_info.uid:
-         sql_update_where_list.append( str ( "uid = '" + entry_info.uid + "'" ) )
+      notify_uid, notify_size, notify_path = notify_row[ 0 : 3 ]
       
-      if notify_item.path != entry_info.path:
-         sql_update_where_list.append( str ( "path = '" + entry_info.path + "'" ) )
+      # Only entries with a changed uid, path or size get those columns rewritten,
+      # all others just have last_check refreshed within one IN list per batch.
+      if notify_uid != uid or notify_path != path or notify_size != size:
+         self.update_notify_queue.append( ( check_timestamp, uid, path, size, fid ) )
+      else:
+         self.last_check_queue.setdefault( check_timestamp, list() ).append( fid )
       
-      if notify_item.size != entry_info.size:
-         sql_update_where_list.append( str ( "size = '" + str( entry_info.size ) + "'" ) )
+      queued_count = len( self.update_notify_queue ) + sum( len( fid_list ) for fid_list in self.last_check_queue.values() )
       
-      sql = "UPDATE " + self.db + "." + self.table + " SET last_check = '" + check_timestamp + "'"
+      if queued_count >= self.batch_size:
+         self.flush_last_check_queue()
+
+   def flush_last_check_queue( self ):
       
-      if len( sql_update_where_list ) > 1:
+      if self.update_notify_queue:
          
-         for item in sql_update_where_list:
-            sql += ", " + item
-      
-      sql += " WHERE fid = '" + entry_info.fid + "'"
+         sql = "UPDATE " + self.db + "." + self.table + " SET last_check = %s, uid = %s, path = %s, size = %s WHERE fid = %s"
+         
+         self._execute_batched( sql, self.update_notify_queue )
+         
+         self.update_notify_queue = list()
       
-      self.logger.debug( sql )
-      self.cur.execute( sql )
+      if self.last_check_queue:
+         
+         sql = "UPDATE " + self.db + "." + self.table + " SET last_check = %s WHERE fid IN (%s)"
+         
+         self.logger.debug( sql )
+         
+         for check_timestamp, queued_fid_list in self.last_check_queue.items():
+            
+            for i in range( 0, len( queued_fid_list ), self.batch_size ):
+               
+               fid_list = queued_fid_list[ i : i + self.batch_size ]
+               
+               start_time = time.time()
+               
+               self.cur.execute( sql % ( '%s', ', '.join( [ '%s' ] * len( fid_list ) ) ), [ check_timestamp ] + fid_list )
+               
+               self.logger.debug( "Executed batch of %d rows in %.3f seconds.", len( fid_list ), time.time() - start_time )
+         
+         self.last_check_queue = dict()
 
    def purge_old_table_entries( self, check_timestamp ):
       
-      sql = "DELETE FROM " + self.db + "." + self.table + " WHERE last_check < '" + check_timestamp + "'"
+      # Pending last check updates must be written before comparing against the check timestamp.
+      self.flush_last_check_queue()
+      
+      sql = "DELETE FROM " + self.db + "." + self.table + " WHERE last_check < %s LIMIT %s"
       
       self.logger.debug( sql )
-      self.cur.execute( sql )
       
-      if self.cur.rowcount > 0:
-         self.logger.info( "Purged old notification table entries: " + str( self.cur.rowcount ) )
+      purged_count = 0
+      
+      # Bounded deletes keep locks short, so concurrent readers are not stalled by the purge.
+      while True:
+         
+         self.cur.execute( sql, ( check_timestamp, self.purge_batch_size ) )
+         
+         purged_count += self.cur.rowcount
+         
+         if self.cur.rowcount < self.purge_batch_size:
+            break
+         
+         # Replicas and concurrent writers catch up between the batches.
+         if self.purge_pause:
+            time.sleep( self.purge_pause )
+      
+      if purged_count > 0:
+         self.logger.info( "Purged old notification table entries: " + str( purged_count ) )
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sqlite_robinhood.py
+#
+#  SQLite stand-in for a Robinhood MySQL database providing the subset of
+#  the MySQLdb interface that is used by the table handlers.
+#
+#  Gabriele Iannetti <g.iannetti@gsi.de>
+
+
+import datetime
+import random
+import re
+import sqlite3
+
+
+DELETE_LIMIT_REG_EXP = re.compile( r'^\s*DELETE FROM (\S+) WHERE (.+) LIMIT (\S+)\s*$', re.IGNORECASE | re.DOTALL )
+TRUNCATE_REG_EXP     = re.compile( r'^\s*TRUNCATE (\S+)\s*$', re.IGNORECASE )
+USE_REG_EXP          = re.compile( r'^\s*USE \S+\s*$', re.IGNORECASE )
+
+ROOT_FID = '0x200000007:0x1:0x0'
+
+SCHEMA = """
+CREATE TABLE {db}.ENTRIES (
+id TEXT PRIMARY KEY,
+uid TEXT,
+gid TEXT,
+size INTEGER,
+type TEXT,
+last_access INTEGER,
+last_mod INTEGER,
+md_update INTEGER,
+fileclass TEXT
+);
+CREATE TABLE {db}.NAMES (
+id TEXT PRIMARY KEY,
+parent_id TEXT,
+name TEXT
+);
+CREATE TABLE {db}.NOTIFIES (
+fid TEXT NOT NULL PRIMARY KEY,
+uid TEXT NOT NULL,
+size INTEGER NOT NULL,
+path TEXT NOT NULL,
+last_check DATETIME NOT NULL,
+last_notify DATETIME DEFAULT NULL,
+ignore_notify TEXT DEFAULT 'FALSE'
+);
+CREATE INDEX {db}.NOTIFIES_last_check_idx ON NOTIFIES (last_check);
+"""
+
+
+class Statistics:
+
+   query_count = 0
+
+   def reset():
+      Statistics.query_count = 0
+
+
+def translate_sql( sql ):
+
+   if USE_REG_EXP.match( sql ):
+      return None
+
+   matched = TRUNCATE_REG_EXP.match( sql )
+
+   if matched:
+      return "DELETE FROM " + matched.group( 1 )
+
+   matched = DELETE_LIMIT_REG_EXP.match( sql )
+
+   if matched:
+
+      table = matched.group( 1 )
+
+      sql = "DELETE FROM " + table + " WHERE rowid IN (SELECT rowid FROM " + table + " WHERE " + matched.group( 2 ) + " LIMIT " + matched.group( 3 ) + ")"
+
+   return sql.replace( '%s', '?' )
+
+
+def regexp( pattern, value ):
+
+   if value is None:
+      return False
+
+   return re.search( pattern, str( value ) ) is not None
+
+
+class Cursor:
+
+   def __init__( self, conn ):
+
+      self.conn     = conn
+      self.cur      = conn.sqlite_conn.cursor()
+      self.rows     = list()
+      self.rowcount = -1
+
+   def execute( self, sql, params = None ):
+
+      Statistics.query_count += 1
+
+      sql = translate_sql( sql )
+
+      if sql is None:
+         return
+
+      self.cur.execute( sql, params or () )
+
+      if self.cur.description:
+
+         # Like MySQLdb the result set is buffered on the client, so rowcount is set for queries.
+         self.rows     = self.cur.fetchall()
+         self.rowcount = len( self.rows )
+
+      else:
+
+         self.rows     = list()
+         self.rowcount = self.cur.rowcount
+
+         if self.conn.is_autocommit:
+            self.conn.commit()
+
+   def executemany( self, sql, params_list ):
+
+      Statistics.query_count += 1
+
+      self.cur.executemany( translate_sql( sql ), params_list )
+
+      self.rows     = list()
+      self.rowcount = self.cur.rowcount
+
+      if self.conn.is_autocommit:
+         self.conn.commit()
+
+   def fetchone( self ):
+
+      if self.rows:
+         return self.rows.pop( 0 )
+
+      return None
+
+   def fetchall( self ):
+
+      rows = self.rows
+
+      self.rows = list()
+
+      return rows
+
+   def close( self ):
+      self.cur.close()
+
+
+class Connection:
+
+   def __init__( self, path, db ):
+
+      self.sqlite_conn   = sqlite3.connect( ':memory:', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False )
+      self.is_autocommit = False
+
+      self.sqlite_conn.create_function( 'REGEXP', 2, regexp )
+
+      # Attaching the database file under the Robinhood database name keeps qualified table names working.
+      self.sqlite_conn.execute( "ATTACH DATABASE ? AS " + db, ( path, ) )
+
+   def autocommit( self, flag ):
+      self.is_autocommit = flag
+
+   def cursor( self ):
+      return Cursor( self )
+
+   def commit( self ):
+      self.sqlite_conn.commit()
+
+   def rollback( self ):
+      self.sqlite_conn.rollback()
+
+   def close( self ):
+      self.sqlite_conn.close()
+
+
+def connect( host = None, user = None, passwd = None, db = None, **kwargs ):
+   """The host parameter specifies the path of the SQLite database file."""
+
+   return Connection( host, db )
+
+
+sqlite3.register_converter( 'DATETIME', lambda value : datetime.datetime.fromisoformat( value.decode() ) )
+
+
+def create_schema( conn, db ):
+
+   conn.sqlite_conn.executescript( SCHEMA.format( db=db ) )
+
+
+def populate( conn, db, depth, fanout, num_entries, num_users, large_ratio, large_size, batch_size = 10000 ):
+   """Creates a synthetic directory tree with num_entries files distributed over the leaf directories.
+
+   Returns the number of directories and files that have been created.
+   """
+
+   rnd = random.Random( 0 )
+
+   sequence = [ 1 ]
+
+   def next_fid():
+
+      sequence[ 0 ] += 1
+
+      return "0x200000400:0x%x:0x0" % sequence[ 0 ]
+
+   entries = list()
+   names   = list()
+
+   def flush():
+
+      conn.sqlite_conn.executemany( "INSERT INTO " + db + ".ENTRIES (id, uid, gid, size, type, last_access, last_mod, md_update) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries )
+      conn.sqlite_conn.executemany( "INSERT INTO " + db + ".NAMES (id, parent_id, name) VALUES (?, ?, ?)", names )
+
+      del entries[:]
+      del names[:]
+
+   level_dirs = [ ROOT_FID ]
+   num_dirs   = 0
+
+   for level in range( depth ):
+
+      next_level_dirs = list()
+
+      for parent_fid in level_dirs:
+
+         for i in range( fanout ):
+
+            fid = next_fid()
+
+            entries.append( ( fid, 'root', 'root', 4096, 'dir', 0, 0, 0 ) )
+            names.append( ( fid, parent_fid, "dir%d_%d" % ( level, i ) ) )
+
+            next_level_dirs.append( fid )
+
+            num_dirs += 1
+
+      level_dirs = next_level_dirs
+
+      if len( entries ) >= batch_size:
+         flush()
+
+   for i in range( num_entries ):
+
+      fid = next_fid()
+      uid = "user%d" % ( i % num_users )
+
+      if rnd.random() < large_ratio:
+         size = large_size + rnd.randrange( large_size )
+      else:
+         size = rnd.randrange( large_size )
+
+      entries.append( ( fid, uid, uid, size, 'file', 0, 0, 0 ) )
+      names.append( ( fid, level_dirs[ i % len( level_dirs ) ], "file%d" % i ) )
+
+      if len( entries ) >= batch_size:
+         flush()
+
+   flush()
+
+   conn.commit()
+
+   return num_dirs, num_entries
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright 2026 Gabriele Iannetti <g.iannetti@gsi.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import argparse
+import importlib.util
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from lib import sqlite_robinhood
+from lib.version.minimal_python import MinimalPython
+
+
+DATABASE='robinhood'
+
+CONFIG_TEMPLATE="""[mysqld]
+host     = {path}
+database = {db}
+user     =
+password =
+
+[check]
+file_size           = {file_size}
+file_system         = /lustre/fs
+check_interval_days = 7
+
+[notify]
+table    = NOTIFIES
+database = {db}
+
+[mail]
+server             =
+sender             =
+overview_recipient =
+subject            = Large File Report
+send_user_mail     = off
+
+[ldap]
+server =
+dc     =
+"""
+
+
+def load_notifier():
+
+   # The notifier connects through the SQLite stand-in instead of MySQLdb.
+   sys.modules[ 'MySQLdb' ] = sqlite_robinhood
+
+   path = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'rbh-large-file-notifier.py' )
+
+   spec   = importlib.util.spec_from_file_location( 'rbh_large_file_notifier', path )
+   module = importlib.util.module_from_spec( spec )
+
+   # Registered for worker processes to find the functions of the notifier.
+   sys.modules[ spec.name ] = module
+
+   spec.loader.exec_module( module )
+
+   return module
+
+
+def main():
+
+   MinimalPython.check()
+
+   parser = argparse.ArgumentParser( description='Runs the large file notifier against a synthetic SQLite Robinhood database and reports query count, wall time and peak memory.' )
+   parser.add_argument( '-d', '--depth', dest='depth', type=int, required=False, default=4, help='Depth of the synthetic directory tree. Default: 4' )
+   parser.add_argument( '-b', '--fanout', dest='fanout', type=int, required=False, default=8, help='Number of subdirectories per directory. Default: 8' )
+   parser.add_argument( '-n', '--entries', dest='entries', type=int, required=False, default=1000000, help='Number of files in the synthetic tree. Default: 1000000' )
+   parser.add_argument( '-u', '--users', dest='users', type=int, required=False, default=100, help='Number of distinct file owners. Default: 100' )
+   parser.add_argument( '-l', '--large-ratio', dest='large_ratio', type=float, required=False, default=0.01, help='Ratio of files that exceed the file size threshold. Default: 0.01' )
+   parser.add_argument( '-s', '--file-size', dest='file_size', type=str, required=False, default='500GB', help='File size thresholds of the notifier, separated by comma for several tiers. Default: 500GB' )
+   parser.add_argument( '-r', '--runs', dest='runs', type=int, required=False, default=2, help='Number of consecutive notifier runs, the first one inserts into the notifier table and later ones update it. Default: 2' )
+   parser.add_argument( '-j', '--workers', dest='workers', type=int, required=False, default=1, help='Number of notifier worker processes, queries of worker processes are not included in the query count. Default: 1' )
+   parser.add_argument( '-w', '--work-dir', dest='work_dir', type=str, required=False, help='Directory for the SQLite database file. Default: temporary directory' )
+   parser.add_argument( '-D', '--enable-debug', dest='enable_debug', required=False, action='store_true', help='Enables logging of debug messages.' )
+
+   args = parser.parse_args()
+
+   logging_level = logging.INFO
+
+   if args.enable_debug:
+      logging_level = logging.DEBUG
+
+   logging.basicConfig( level=logging_level, format='%(asctime)s - %(levelname)s: %(message)s' )
+
+   notifier = load_notifier()
+
+   large_size = min( [ notifier.calc_threshold( file_size.strip() ) for file_size in args.file_size.split( ',' ) ] )
+
+   with tempfile.TemporaryDirectory( dir=args.work_dir ) as work_dir:
+
+      db_path     = os.path.join( work_dir, DATABASE + '.sqlite' )
+      config_path = os.path.join( work_dir, 'rbh-large-file-notifier.conf' )
+
+      with open( config_path, 'w' ) as config_file:
+         config_file.write( CONFIG_TEMPLATE.format( path=db_path, db=DATABASE, file_size=args.file_size ) )
+
+      conn = sqlite_robinhood.connect( host=db_path, db=DATABASE )
+
+      start_time = time.time()
+
+      sqlite_robinhood.create_schema( conn, DATABASE )
+      num_dirs, num_files = sqlite_robinhood.populate( conn, DATABASE, args.depth, args.fanout, args.entries, args.users, args.large_ratio, large_size )
+
+      conn.close()
+
+      logging.info( "Populated %d directories and %d files in %.2f seconds.", num_dirs, num_files, time.time() - start_time )
+
+      print( "run;queries;wall_time_s;peak_rss_mb" )
+
+      for run in range( 1, args.runs + 1 ):
+
+         sys.argv = [ 'rbh-large-file-notifier.py', '-f', config_path, '--no-mail', '--workers', str( args.workers ) ]
+
+         if args.enable_debug:
+            sys.argv.append( '-D' )
+
+         sqlite_robinhood.Statistics.reset()
+
+         start_time = time.time()
+
+         notifier.main()
+
+         wall_time = time.time() - start_time
+
+         # Peak resident set size of the process so far, reported in KB on Linux.
+         peak_rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024
+
+         print( "%d;%d;%.2f;%.1f" % ( run, sqlite_robinhood.Statistics.query_count, wall_time, peak_rss ) )
+
+   return 0
+
+
+if __name__ == '__main__':
+   main()
@@ -18,7 +18,7 @@
 #
 
 
-import ConfigParser
+import configparser
 import logging
 import argparse
 import MySQLdb
@@ -26,12 +26,18 @@ import os
 import re
 import time, datetime
 import smtplib
-import commands
+import subprocess
+import multiprocessing
+import heapq
+import tempfile
+import gzip
+import base64
+import shutil
 
 from contextlib import closing
-from cStringIO import StringIO
-from lib.entries_table_handler import EntriesTableHandler
-from lib.notifier_table_handler import NotifierTableHandler, NotifyInfo
+from io import StringIO
+from lib.entries_table_handler import EntriesTableHandler, split_rows_by_uid_shard
+from lib.notifier_table_handler import NotifierTableHandler, BATCH_SIZE, PURGE_BATCH_SIZE, PURGE_PAUSE, ENGINE, export_compact_to_csv, export_full_to_csv
 
 
 FILES_REG_EXP=r'^\d{1,3}(GB|TB)$'
@@ -41,67 +47,142 @@ FILES_REG_EXP=r'^\d{1,3}(GB|TB)$'
 GB_MULTIPLIER=1073741824
 TB_MULTIPLIER=1099511627776
 
+OVERVIEW_REPORT_HEADER='uid;size;path;last_notify'
+
+TEMP_FILE_PREFIX='rbh-large-file-notifier-'
+
+# Multiple of 57 bytes, which are encoded into one base64 line of 76 characters.
+BASE64_CHUNK_SIZE=57 * 1024
+
+
+class CheckInfo:
+   
+   def __init__( self, name, database, file_system, file_size_list, check_interval_days, notify_table ):
+      
+      self.name                = name
+      self.database            = database
+      self.file_system         = file_system
+      self.check_interval_days = check_interval_days
+      self.notify_table        = notify_table
+      
+      # Tiers are sorted ascending by threshold, so the first tier determines the scan of the ENTRIES table.
+      self.tier_list = sorted( [ ( file_size, calc_threshold( file_size ) ) for file_size in file_size_list ], key=lambda tier : tier[ 1 ] )
+
+
+class MailInfo:
+   
+   def __init__( self, config, no_mail ):
+      
+      self.enabled            = not no_mail
+      self.server             = config.get( 'mail', 'server' )
+      self.sender             = config.get( 'mail', 'sender' )
+      self.subject            = config.get( 'mail', 'subject' )
+      self.overview_recipient = config.get( 'mail', 'overview_recipient' )
+      self.user_notification  = config.get( 'mail', 'send_user_mail' )
+      self.ldap_server        = config.get( 'ldap', 'server' )
+      self.ldap_dc            = config.get( 'ldap', 'dc' )
+
+
+def get_check_section_list( config ):
+   
+   # Additional file systems are configured in sections named check:<name>.
+   return [ section for section in config.sections() if section == 'check' or section.startswith( 'check:' ) ]
+
+
+def create_check_info_list( config ):
+   
+   check_info_list = list()
+   
+   for section in get_check_section_list( config ):
+      
+      database = config.get( 'mysqld', 'database' )
+      
+      if config.has_option( section, 'database' ):
+         database = config.get( section, 'database' )
+      
+      notify_table = config.get( 'notify', 'table' )
+      
+      if config.has_option( section, 'notify_table' ):
+         notify_table = config.get( section, 'notify_table' )
+      
+      file_size_list = [ file_size.strip() for file_size in config.get( section, 'file_size' ).split( ',' ) ]
+      
+      check_info_list.append( CheckInfo( section, database, config.get( section, 'file_system' ), file_size_list, int( config.get( section, 'check_interval_days' ) ), notify_table ) )
+   
+   notify_table_list = [ check_info.notify_table for check_info in check_info_list ]
+   
+   if len( set( notify_table_list ) ) != len( notify_table_list ):
+      raise RuntimeError( 'Each check section must use its own notify table!' )
+   
+   return check_info_list
+
 
 def validate_config_file( config ):
    
    if not config.has_section( 'mysqld' ):
-      raise ConfigParser.NoSectionError( 'Section mysqld was not found!' )
+      raise configparser.NoSectionError( 'mysqld' )
 
    if not config.has_option( 'mysqld', 'host' ):
-      raise ConfigParser.NoOptionError( 'Option host was not found in section mysqld!' )
+      raise configparser.NoOptionError( 'host', 'mysqld' )
    
    if not config.has_option( 'mysqld', 'database' ):
-      raise ConfigParser.NoOptionError( 'Option database was not found in section mysqld!' )
+      raise configparser.NoOptionError( 'database', 'mysqld' )
 
    if not config.has_option( 'mysqld', 'user' ):
-      raise ConfigParser.NoOptionError( 'Option user was not found in section mysqld!' )
+      raise configparser.NoOptionError( 'user', 'mysqld' )
    
    if not config.has_option( 'mysqld', 'password' ):
-      raise ConfigParser.NoOptionError( 'Option password was not found in section mysqld!' )
+      raise configparser.NoOptionError( 'password', 'mysqld' )
 
-   if not config.has_section( 'check' ):
-      raise ConfigParser.NoSectionError( 'Section check was not found!' )
-
-   if not config.has_option( 'check', 'file_size' ):
-      raise ConfigParser.NoOptionError( 'Option file_size was not found in section check!' )
+   check_section_list = get_check_section_list( config )
    
-   if not config.has_option( 'check', 'file_system' ):
-      raise ConfigParser.NoOptionError( 'Option file_system was not found in section check!' )
+   if not check_section_list:
+      raise configparser.NoSectionError( 'check' )
    
-   if not config.has_option( 'check', 'check_interval_days' ):
-      raise ConfigParser.NoOptionError( 'Option check_interval_days was not found in section check!' )
+   for section in check_section_list:
+      
+      if not config.has_option( section, 'file_size' ):
+         raise configparser.NoOptionError( 'file_size', section )
+      
+      if not config.has_option( section, 'file_system' ):
+         raise configparser.NoOptionError( 'file_system', section )
+      
+      if not config.has_option( section, 'check_interval_days' ):
+         raise configparser.NoOptionError( 'check_interval_days', section )
+      
+      for file_size in config.get( section, 'file_size' ).split( ',' ):
+         
+         reg_exp_match = re.match( FILES_REG_EXP, file_size.strip() )
+         
+         if not reg_exp_match:
+            raise RuntimeError( "Failed validation of valid file size format in section " + section + "!" )
    
    if not config.has_option( 'notify', 'table' ):
-      raise ConfigParser.NoOptionError( 'Option table was not found in section notify!' )
+      raise configparser.NoOptionError( 'table', 'notify' )
    
    if not config.has_option( 'notify', 'database' ):
-      raise ConfigParser.NoOptionError( 'Option database was not found in section notify!' )
+      raise configparser.NoOptionError( 'database', 'notify' )
    
    if not config.has_option( 'mail', 'server' ):
-      raise ConfigParser.NoOptionError( 'Option server was not found in section mail!' )
+      raise configparser.NoOptionError( 'server', 'mail' )
    
    if not config.has_option( 'mail', 'sender' ):
-      raise ConfigParser.NoOptionError( 'Option sender was not found in section mail!' )
+      raise configparser.NoOptionError( 'sender', 'mail' )
    
    if not config.has_option( 'mail', 'subject' ):
-      raise ConfigParser.NoOptionError( 'Option subject was not found in section mail!' )
+      raise configparser.NoOptionError( 'subject', 'mail' )
    
    if not config.has_option( 'mail', 'overview_recipient' ):
-      raise ConfigParser.NoOptionError( 'Option overview_recipient was not found in section mail!' )
+      raise configparser.NoOptionError( 'overview_recipient', 'mail' )
    
    if not config.has_option( 'mail', 'send_user_mail' ):
-      raise ConfigParser.NoOptionError( 'Option send_user_mail was not found in section mail!' )
+      raise configparser.NoOptionError( 'send_user_mail', 'mail' )
    
    if not config.has_option( 'ldap', 'server' ):
-      raise ConfigParser.NoOptionError( 'Option server was not found in section ldap!' )
+      raise configparser.NoOptionError( 'server', 'ldap' )
    
    if not config.has_option( 'ldap', 'dc' ):
-      raise ConfigParser.NoOptionError( 'Option dc was not found in section ldap!' )
-   
-   reg_exp_match = re.match( FILES_REG_EXP, config.get( 'check', 'file_size' ) )
-   
-   if not reg_exp_match:
-      raise RuntimeError( 'Failed validation of valid file size format!' )
+      raise configparser.NoOptionError( 'dc', 'ldap' )
    
    send_user_mail = config.get( 'mail', 'send_user_mail' )
    
@@ -157,11 +238,7 @@ def uid_to_mail_ldap( ldap_server, ldap_dc, uid ):
    
    cmd = "KRB5CCNAME=/tmp/krb5cc_nslcd sudo -u nslcd ldapsearch -Y GSSAPI -H ldap://" + ldap_server + "/ -b ou=people,dc=" + ldap_dc + ",dc=de '(uid=" + uid + ")' mail"
    
-   # TODO Deprecated!
-   ( status, output ) = commands.getstatusoutput( cmd )
-   
-   # Python 3.1
-   ##subprocess.getstatusoutput( cmd )
+   ( status, output ) = subprocess.getstatusoutput( cmd )
    
    if status > 0:
       
@@ -186,196 +263,497 @@ def uid_to_mail_ldap( ldap_server, ldap_dc, uid ):
    return None
 
 
-def main():
+def create_notifier_table_handler( cur, config, notify_table ):
+   
+   notify_batch_size = BATCH_SIZE
+   
+   if config.has_option( 'notify', 'batch_size' ):
+      notify_batch_size = int( config.get( 'notify', 'batch_size' ) )
+   
+   notify_purge_batch_size = PURGE_BATCH_SIZE
+   
+   if config.has_option( 'notify', 'purge_batch_size' ):
+      notify_purge_batch_size = int( config.get( 'notify', 'purge_batch_size' ) )
+   
+   notify_purge_pause = PURGE_PAUSE
+   
+   if config.has_option( 'notify', 'purge_pause' ):
+      notify_purge_pause = float( config.get( 'notify', 'purge_pause' ) )
+   
+   notify_engine = ENGINE
+   
+   if config.has_option( 'notify', 'engine' ):
+      notify_engine = config.get( 'notify', 'engine' )
+   
+   return NotifierTableHandler( cur, logging, notify_table, config.get( 'notify', 'database' ), notify_batch_size, notify_purge_batch_size, notify_engine, notify_purge_pause )
 
-   parser = argparse.ArgumentParser( description='Checks for large files and sends e-mail notifications.' )
-   parser.add_argument( '-f', '--config-file', dest='config_file', type=str, required=True, help='Path of the config file.' )
-   parser.add_argument( '-D', '--enable-debug', dest='enable_debug', required=False, action='store_true', help='Enables logging of debug messages.' )
-   parser.add_argument( '--create-table', dest='create_table', required=False, action='store_true', help='If set the notifiers table is created.' )
-   parser.add_argument( '--no-mail', dest='no_mail', required=False, action='store_true', help='Disables mail send.' )
+
+def process_user( uid, entry_info_store, notifier_table_handler, check_info, check_timestamp, mail_info, smtp_conn ):
+   """Notifies an user about the large files of the entry info store.
    
-   args = parser.parse_args()
+   Returns a list of (index, last_notify) for the reported entries of the store.
+   """
    
-   if not os.path.isfile( args.config_file ):
-      raise IOError( "The config file does not exist or is not a file: " + args.config_file )
+   user_report_buf = StringIO()
    
-   logging_level = logging.INFO
+   new_index_list    = list()
+   update_index_list = list()
+   last_notify       = None
    
-   if args.enable_debug:
-      logging_level = logging.DEBUG
+   index_range = entry_info_store.iter_index( uid )
+   
+   # Notifier table rows of the user are looked up in batches and kept as plain tuples.
+   notify_row_map = notifier_table_handler.get_notify_row_map( [ entry_info_store.get_fid( index ) for index in index_range ] )
+   
+   for index in index_range:
+      
+      fid  = entry_info_store.get_fid( index )
+      size = entry_info_store.get_size( index )
+      path = entry_info_store.get_path( index )
+      
+      notify_row = notify_row_map.get( fid )
+   
+      if notify_row:
+         
+         previous_last_notify, ignore_notify = notify_row[ 3 : 5 ]
+         
+         if ignore_notify == 'TRUE':
+            continue
+         
+         last_notify_check = previous_last_notify
 
-   logging.basicConfig( level=logging_level, format='%(asctime)s - %(levelname)s: %(message)s' )
+         if last_notify_check == 'NULL':
 
-   logging.info( 'START' )
+            logging.debug('Retrieved empty last_notify of notifier table row!')
 
-   config = ConfigParser.ConfigParser()
-   config.read( args.config_file )
+            last_notify_check = datetime.datetime( 1970, 1, 1, 00, 00, 00 )
+         
+         last_notify_threshold = last_notify_check + datetime.timedelta( days = check_info.check_interval_days )
+         
+         if last_notify_threshold < datetime.datetime.fromtimestamp( time.time() ):
+            
+            update_index_list.append( ( index, previous_last_notify ) )
+            
+            user_report_buf.write( export_compact_to_csv( size, path ) )
+         
+         notifier_table_handler.update_notify_item_on_last_check( notify_row, fid, uid, size, path, check_timestamp )
+
+      else:
+         
+         new_index_list.append( ( index, 'NULL' ) )
+         
+         user_report_buf.write( export_compact_to_csv( size, path ) )
    
-   validate_config_file( config )
+   large_file_list = user_report_buf.getvalue()
    
-   large_file_size      = config.get( 'check', 'file_size' )
-   threshold            = calc_threshold( large_file_size )
-   file_system          = config.get( 'check', 'file_system' )
-   check_interval_days  = int( config.get( 'check', 'check_interval_days' ) )
+   user_report_buf.close()
    
-   notify_table         = config.get( 'notify', 'table' )
-   notify_database      = config.get( 'notify', 'database' )
+   if large_file_list:
+      
+      mail_receiver = None
+      
+      if mail_info.enabled and mail_info.user_notification == 'on':
+         mail_receiver = uid_to_mail_ldap( mail_info.ldap_server, mail_info.ldap_dc, uid )
+      
+      if mail_receiver:
+      
+         try:
+            
+            # User mails list all files from the lowest tier on.
+            mail_body    = create_user_mail_body( uid, check_info.file_system, check_info.tier_list[ 0 ][ 0 ], large_file_list )
+            mail_subject = mail_info.subject + " - " + check_info.file_system
+            
+            smtp_conn.sendmail( mail_info.sender, mail_receiver, create_mail( mail_info.sender, mail_subject, mail_receiver, mail_body ) )
+            logging.info( "An user report has been sent to: " + mail_receiver )
+            
+            last_notify = datetime.datetime.fromtimestamp( time.time() ).strftime( '%Y-%m-%d %H:%M:%S' )
+            
+            new_index_list    = [ ( index, last_notify ) for index, previous_last_notify in new_index_list ]
+            update_index_list = [ ( index, last_notify ) for index, previous_last_notify in update_index_list ]
+            
+         except smtplib.SMTPException:
+            logging.error( "No user notification mail could be sent to: " + mail_receiver )
+      
+      if new_index_list:
+         
+         new_notify_list = list()
+         
+         for index, new_last_notify in new_index_list:
+            
+            if new_last_notify == 'NULL':
+               new_last_notify = None
+            
+            new_notify_list.append( ( entry_info_store.get_fid( index ), uid, entry_info_store.get_size( index ), entry_info_store.get_path( index ), check_timestamp, new_last_notify ) )
+         
+         notifier_table_handler.insert_new_notify_list( new_notify_list )
+      
+      if update_index_list and last_notify:
+         notifier_table_handler.update_last_notify( [ entry_info_store.get_fid( index ) for index, previous_last_notify in update_index_list ], last_notify )
    
-   rbh_database         = config.get( 'mysqld', 'database' )
+   return new_index_list + update_index_list
+
+
+def write_overview_report( shard_report_path_list, report_path ):
+   """Merges the shard reports of one tier ordered by uid into a gzip compressed CSV file.
    
-   mail_server             = config.get( 'mail', 'server' )
-   mail_sender             = config.get( 'mail', 'sender' )
-   mail_subject            = config.get( 'mail', 'subject' ) + " - " + file_system
-   mail_overview_recipient = config.get( 'mail', 'overview_recipient' )
-   mail_user_notification  = config.get( 'mail', 'send_user_mail' )
+   Returns the number of written report lines.
+   """
    
-   ldap_server          = config.get( 'ldap', 'server' )
-   ldap_dc              = config.get( 'ldap', 'dc' )
+   num_lines = 0
    
-   if not args.no_mail:
-      smtp_conn = smtplib.SMTP( mail_server )
+   shard_report_file_list = [ open( shard_report_path, 'r' ) for shard_report_path in shard_report_path_list ]
    
-   with closing( MySQLdb.connect( host=config.get( 'mysqld', 'host' ), user=config.get( 'mysqld', 'user' ), passwd=config.get( 'mysqld', 'password' ), db=rbh_database ) )  as conn:
-      with closing( conn.cursor() ) as cur:
+   try:
+      
+      with gzip.open( report_path, 'wt' ) as report_file:
          
-         conn.autocommit( True )
+         report_file.write( OVERVIEW_REPORT_HEADER + "\n" )
+         
+         last_uid = None
          
-         entries_table_handler  = EntriesTableHandler( cur, logging, rbh_database, threshold, file_system )
-         notifier_table_handler = NotifierTableHandler( cur, logging, notify_table, notify_database )
+         # The lines of each shard report are sorted by uid, so merging streams from disk without holding the report in memory.
+         for line in heapq.merge( *shard_report_file_list, key=lambda line : line.split( ';', 1 )[ 0 ] ):
+            
+            uid = line.split( ';', 1 )[ 0 ]
+            
+            # One additional line break after a user specific file list in the overview report.
+            if last_uid is not None and uid != last_uid:
+               report_file.write( '\n' )
             
-         if args.create_table:
-            notifier_table_handler.create_notifier_table()
+            report_file.write( line )
+            
+            last_uid = uid
+            num_lines += 1
          
-         entry_info_map = entries_table_handler.get_entry_info_map()
+         if last_uid is not None:
+            report_file.write( '\n' )
+   
+   finally:
+      
+      for shard_report_file in shard_report_file_list:
+         shard_report_file.close()
+   
+   return num_lines
+
+
+def create_overview_mail_file( sender, subject, receiver, text, report_path, mail_path ):
+   
+   boundary = "=====rbh-large-file-notifier-" + str( int( time.time() ) ) + "====="
+   
+   attachment_name = os.path.basename( report_path )
+   
+   with open( mail_path, 'wb' ) as mail_file:
+      
+      header = "From: <" + sender + ">\r\n" \
+               "To: <" + receiver + ">\r\n" \
+               "Subject: " + subject + "\r\n" \
+               "MIME-Version: 1.0\r\n" \
+               "Content-Type: multipart/mixed; boundary=\"" + boundary + "\"\r\n" \
+               "\r\n" \
+               "--" + boundary + "\r\n" \
+               "Content-Type: text/plain; charset=utf-8\r\n" \
+               "Content-Transfer-Encoding: 8bit\r\n" \
+               "\r\n" + text.replace( "\n", "\r\n" ) + "\r\n" \
+               "--" + boundary + "\r\n" \
+               "Content-Type: application/gzip; name=\"" + attachment_name + "\"\r\n" \
+               "Content-Transfer-Encoding: base64\r\n" \
+               "Content-Disposition: attachment; filename=\"" + attachment_name + "\"\r\n" \
+               "\r\n"
+      
+      mail_file.write( header.encode() )
+      
+      with open( report_path, 'rb' ) as report_file:
          
-         check_timestamp = datetime.datetime.fromtimestamp( time.time() ).strftime( '%Y-%m-%d %H:%M:%S' )
+         while True:
+            
+            chunk = report_file.read( BASE64_CHUNK_SIZE )
+            
+            if not chunk:
+               break
+            
+            mail_file.write( base64.encodebytes( chunk ).replace( b"\n", b"\r\n" ) )
+      
+      mail_file.write( ( "--" + boundary + "--\r\n" ).encode() )
+
+
+def send_mail_file( smtp_conn, sender, receiver, mail_path ):
+   
+   # smtplib expects the whole message in memory, so the DATA command is streamed line by line from the mail file.
+   smtp_conn.ehlo_or_helo_if_needed()
+   
+   ( code, response ) = smtp_conn.mail( sender )
+   
+   if code != 250:
+      smtp_conn.rset()
+      raise smtplib.SMTPSenderRefused( code, response, sender )
+   
+   ( code, response ) = smtp_conn.rcpt( receiver )
+   
+   if code not in ( 250, 251 ):
+      smtp_conn.rset()
+      raise smtplib.SMTPRecipientsRefused( { receiver : ( code, response ) } )
+   
+   ( code, response ) = smtp_conn.docmd( 'DATA' )
+   
+   if code != 354:
+      smtp_conn.rset()
+      raise smtplib.SMTPDataError( code, response )
+   
+   with open( mail_path, 'rb' ) as mail_file:
+      
+      for line in mail_file:
          
-         overview_report_buf = StringIO()
+         if line.startswith( b'.' ):
+            line = b'.' + line
          
-         if entry_info_map:
+         smtp_conn.send( line )
+   
+   smtp_conn.send( b".\r\n" )
+   
+   ( code, response ) = smtp_conn.getreply()
+   
+   if code != 250:
+      raise smtplib.SMTPDataError( code, response )
+
+
+def send_overview_report( smtp_conn, mail_info, check_info, file_size, report_path ):
+   
+   mail_subject = mail_info.subject + " - " + check_info.file_system
+   
+   if len( check_info.tier_list ) > 1:
+      mail_subject += " - " + file_size
+   
+   mail_path = report_path + '.eml'
+   
+   # The mail file is removed together with the report directory.
+   try:
+      
+      mail_body = """Dear All,\n
+this is the automated report of stored large files on '""" + check_info.file_system + """' that are equal or larger than """ + file_size + """.\n
+The report is attached as gzip compressed file in CSV format: """ + OVERVIEW_REPORT_HEADER + """\n"""
+      
+      create_overview_mail_file( mail_info.sender, mail_subject, mail_info.overview_recipient, mail_body, report_path, mail_path )
+      
+      send_mail_file( smtp_conn, mail_info.sender, mail_info.overview_recipient, mail_path )
+      logging.info( "An overview report has been sent to: " + mail_info.overview_recipient )
+
+   except smtplib.SMTPException:
+      logging.error( "No overview report could be sent to: " + mail_info.overview_recipient )
+
+
+def create_db_connection( config, database ):
+   
+   return MySQLdb.connect( host=config.get( 'mysqld', 'host' ), user=config.get( 'mysqld', 'user' ), passwd=config.get( 'mysqld', 'password' ), db=database )
+
+
+def process_shard( config, check_info, mail_info, check_timestamp, rows, report_path_list ):
+   """Processes the large file rows of one uid shard with an own database connection.
+   
+   The overview report lines of the shard are written sorted by uid to the report path of each tier.
+   Returns the number of large files found.
+   """
+   
+   report_file_list = list()
+   num_entries      = 0
+   smtp_conn        = None
+   
+   try:
+      
+      for report_path in report_path_list:
+         report_file_list.append( open( report_path, 'w' ) )
+      
+      if mail_info.enabled and mail_info.user_notification == 'on':
+         smtp_conn = smtplib.SMTP( mail_info.server )
+      
+      with closing( create_db_connection( config, check_info.database ) ) as conn:
+         with closing( conn.cursor() ) as cur:
+            
+            # Each user is committed on its own, so a failing worker leaves the notifier table consistent for completed users.
+            conn.autocommit( False )
             
-            num_entries = 0
+            entries_table_handler  = EntriesTableHandler( cur, logging, check_info.database, check_info.tier_list[ 0 ][ 1 ], check_info.file_system )
+            notifier_table_handler = create_notifier_table_handler( cur, config, check_info.notify_table )
             
-            for uid in entry_info_map.keys():
+            entry_info_store = entries_table_handler.get_entry_info_store( rows )
+            
+            num_entries = len( entry_info_store )
+            
+            for uid in sorted( entry_info_store.get_uid_list() ):
                
-               user_report_buf = StringIO()
+               reported_list = process_user( uid, entry_info_store, notifier_table_handler, check_info, check_timestamp, mail_info, smtp_conn )
                
-               new_notify_info_list    = list()
-               update_notify_info_list = list()
-               last_notify             = None
+               notifier_table_handler.flush_last_check_queue()
                
-               for entry_info in entry_info_map[ uid ]:
-                  
-                  # TODO: Get a list for each user instead...
-                  notify_item = notifier_table_handler.get_notify_item( entry_info.fid )
+               conn.commit()
                
-                  if notify_item:
+               # The overview report is written incrementally to disk as users are processed.
+               for ( file_size, threshold ), report_file in zip( check_info.tier_list, report_file_list ):
+                  
+                  for index, last_notify in reported_list:
                      
-                     if notify_item.ignore_notify == 'TRUE':
-                        continue
+                     size = entry_info_store.get_size( index )
                      
-                     last_notify_check = notify_item.last_notify
-
-                     if last_notify_check == 'NULL':
-
-                        logging.debug('Retrieved empty notify_item.last_notify!')
+                     if size >= threshold:
+                        report_file.write( export_full_to_csv( uid, size, entry_info_store.get_path( index ), last_notify ) )
+            
+            entries_table_handler.reset_fid_map()
+   
+   except Exception:
+      
+      # Incomplete reports of a failed shard are not left behind.
+      for report_file in report_file_list:
+         
+         report_file.close()
+         os.remove( report_file.name )
+      
+      raise
+   
+   finally:
+      
+      for report_file in report_file_list:
+         report_file.close()
+      
+      if smtp_conn:
+         smtp_conn.quit()
+   
+   return num_entries
 
-                        last_notify_check = datetime.datetime( 1970, 1, 1, 00, 00, 00 )
-                     
-                     last_notify_threshold = last_notify_check + datetime.timedelta( days = check_interval_days )
-                     
-                     if last_notify_threshold < datetime.datetime.fromtimestamp( time.time() ):
-                        
-                        notify_info = NotifyInfo( entry_info.fid, entry_info.uid, entry_info.size, entry_info.path, check_timestamp, notify_item.last_notify )
-                        
-                        update_notify_info_list.append( notify_info )
-                        
-                        user_report_buf.write( notify_info.export_compact_to_csv() )
-                     
-                     notifier_table_handler.update_notify_item_on_last_check( notify_item, entry_info, check_timestamp )
 
-                  else:
-                     
-                     new_notify_info = NotifyInfo( entry_info.fid, entry_info.uid, entry_info.size, entry_info.path, check_timestamp )
-                     
-                     new_notify_info_list.append( new_notify_info )
-                     
-                     user_report_buf.write( new_notify_info.export_compact_to_csv() )
-               
-               large_file_list = user_report_buf.getvalue()
-               
-               if large_file_list:
-                  
-                  mail_receiver = uid_to_mail_ldap( ldap_server, ldap_dc, uid )
-                  
-                  if not args.no_mail and mail_user_notification == 'on' and mail_receiver:
-                  
-                     try:
-                        
-                        mail_body = create_user_mail_body( uid, file_system, large_file_size, large_file_list )
-                        
-                        smtp_conn.sendmail( mail_sender, mail_receiver, create_mail( mail_sender, mail_subject, mail_receiver, mail_body ) )
-                        logging.info( "An user report has been sent to: " + mail_receiver )
-                        
-                        last_notify = datetime.datetime.fromtimestamp( time.time() ).strftime( '%Y-%m-%d %H:%M:%S' )
-                        
-                        for notify_info in new_notify_info_list:
-                           notify_info.last_notify = last_notify
-                           
-                        for notify_info in update_notify_info_list:
-                           notify_info.last_notify = last_notify
-                        
-                     except smtplib.SMTPException:
-                        logging.error( "No user notification mail could be sent to: " + mail_receiver )
-                  
-                  if new_notify_info_list:
-                     notifier_table_handler.insert_new_notify_info_list( new_notify_info_list )
-                  
-                  if update_notify_info_list and last_notify:
-                     notifier_table_handler.update_last_notify( update_notify_info_list, last_notify )
-               
-               for notify_info in new_notify_info_list:
-                  overview_report_buf.write( notify_info.export_full_to_csv() )
-                  
-               for notify_info in update_notify_info_list:
-                  overview_report_buf.write( notify_info.export_full_to_csv() )
-               
-               # One additional line break after a user specific file list in the overview report.
-               if new_notify_info_list or update_notify_info_list:
-                  overview_report_buf.write( '\n' )
-            
-               user_report_buf.close()
+def process_database( args, config, database, check_info_list, mail_info, smtp_conn ):
+   """Processes the check sections of one Robinhood database with a single scan of its ENTRIES table."""
+   
+   with closing( create_db_connection( config, database ) ) as conn:
+      with closing( conn.cursor() ) as cur:
+         
+         conn.autocommit( True )
+         
+         # A single scan at the lowest threshold of all check sections serves all their tiers and workers.
+         threshold = min( [ check_info.tier_list[ 0 ][ 1 ] for check_info in check_info_list ] )
+         
+         rows = EntriesTableHandler( cur, logging, database, threshold, None ).get_large_file_rows()
+         
+         for check_info in check_info_list:
             
-            entries_table_handler.reset_fid_map()
+            check_threshold = check_info.tier_list[ 0 ][ 1 ]
             
-            overview_report_list = overview_report_buf.getvalue()
+            process_check( args, cur, config, check_info, [ row for row in rows if row[ 2 ] >= check_threshold ], mail_info, smtp_conn )
+
+
+def process_check( args, cur, config, check_info, rows, mail_info, smtp_conn ):
+   
+   logging.info( "Processing check section: " + check_info.name )
+   
+   notifier_table_handler = create_notifier_table_handler( cur, config, check_info.notify_table )
+      
+   if args.create_table:
+      notifier_table_handler.create_notifier_table()
+   
+   if args.migrate_table:
+      notifier_table_handler.migrate_notifier_table()
+   
+   check_timestamp = datetime.datetime.fromtimestamp( time.time() ).strftime( '%Y-%m-%d %H:%M:%S' )
+   
+   # The parent owns the report directory, so the shard reports are removed on every path.
+   report_dir = tempfile.mkdtemp( prefix=TEMP_FILE_PREFIX )
+   
+   try:
+      
+      shard_args_list        = list()
+      shard_report_path_list = list()
+      
+      for shard, shard_rows in enumerate( split_rows_by_uid_shard( rows, args.workers ) ):
+         
+         report_path_list = [ os.path.join( report_dir, "shard-" + str( shard ) + "-" + file_size + ".csv" ) for file_size, threshold in check_info.tier_list ]
+         
+         shard_args_list.append( ( config, check_info, mail_info, check_timestamp, shard_rows, report_path_list ) )
+         shard_report_path_list.append( report_path_list )
+      
+      if args.workers > 1:
+         
+         with multiprocessing.Pool( args.workers ) as pool:
+            num_entries = sum( pool.starmap( process_shard, shard_args_list ) )
+      
+      else:
+         num_entries = process_shard( *shard_args_list[ 0 ] )
+      
+      if num_entries:
+         
+         if mail_info.enabled:
             
-            if not args.no_mail and overview_report_list:
+            for i, ( file_size, threshold ) in enumerate( check_info.tier_list ):
                
-               try:
-                  
-                  mail_body = """Dear All,\n
-this is the automated report of stored large files on '""" + file_system + """' that are equal or larger than """ + large_file_size + """.\n
-The following information is provided in CSV format: uid;size;path;last_notify\n\n""" + overview_report_list + """\n"""
-                     
-                  smtp_conn.sendmail( mail_sender, mail_overview_recipient, create_mail( mail_sender, mail_subject, mail_overview_recipient, mail_body ) )
-                  logging.info( "An overview report has been sent to: " + mail_overview_recipient )
+               report_path = os.path.join( report_dir, "large-files-" + check_info.name.replace( ':', '-' ) + "-" + file_size + ".csv.gz" )
+               
+               # The shard reports are sorted by uid, so the merged overview report is independent of the number of workers.
+               if write_overview_report( [ report_path_list[ i ] for report_path_list in shard_report_path_list ], report_path ):
+                  send_overview_report( smtp_conn, mail_info, check_info, file_size, report_path )
+      
+      else:
          
-               except smtplib.SMTPException:
-                  logging.error( "No overview report could be sent to: " + mail_overview_recipient )
+         logging.info( 'No large files were found!' )
          
-         else:
-            
-            logging.info( 'No large files were found!' )
-            
-            if notifier_table_handler.is_table_empty():
-               notifier_table_handler.truncate_table()
+         if notifier_table_handler.is_table_empty():
+            notifier_table_handler.truncate_table()
+   
+   finally:
+      shutil.rmtree( report_dir )
+   
+   notifier_table_handler.purge_old_table_entries( check_timestamp )
+
+
+def main():
+
+   parser = argparse.ArgumentParser( description='Checks for large files and sends e-mail notifications.' )
+   parser.add_argument( '-f', '--config-file', dest='config_file', type=str, required=True, help='Path of the config file.' )
+   parser.add_argument( '-D', '--enable-debug', dest='enable_debug', required=False, action='store_true', help='Enables logging of debug messages.' )
+   parser.add_argument( '--create-table', dest='create_table', required=False, action='store_true', help='If set the notifiers table is created.' )
+   parser.add_argument( '--migrate-table', dest='migrate_table', required=False, action='store_true', help='If set the notifiers table is migrated to the current schema and storage engine.' )
+   parser.add_argument( '--no-mail', dest='no_mail', required=False, action='store_true', help='Disables mail send.' )
+   parser.add_argument( '-w', '--workers', dest='workers', type=int, required=False, default=1, help='Number of worker processes, each processing the users of one uid shard with an own database connection. The ENTRIES table is scanned once by the parent process, which passes the large files of each shard to its worker. Default: 1' )
+   
+   args = parser.parse_args()
+   
+   if args.workers < 1:
+      raise RuntimeError( 'Number of workers must be a positive number!' )
+   
+   if not os.path.isfile( args.config_file ):
+      raise IOError( "The config file does not exist or is not a file: " + args.config_file )
+   
+   logging_level = logging.INFO
+   
+   if args.enable_debug:
+      logging_level = logging.DEBUG
+
+   logging.basicConfig( level=logging_level, format='%(asctime)s - %(levelname)s: %(message)s' )
+
+   logging.info( 'START' )
+
+   config = configparser.ConfigParser()
+   config.read( args.config_file )
+   
+   validate_config_file( config )
+   
+   check_info_list = create_check_info_list( config )
+   mail_info       = MailInfo( config, args.no_mail )
+   smtp_conn       = None
+   
+   # User mails are sent by the shard processing with own connections.
+   if mail_info.enabled:
+      smtp_conn = smtplib.SMTP( mail_info.server )
+   
+   database_list = list()
+   
+   for check_info in check_info_list:
+      if check_info.database not in database_list:
+         database_list.append( check_info.database )
    
-         notifier_table_handler.purge_old_table_entries( check_timestamp )
+   # Check sections on the same Robinhood database share one scan of its ENTRIES table.
+   for database in database_list:
+      process_database( args, config, database, [ check_info for check_info in check_info_list if check_info.database == database ], mail_info, smtp_conn )
    
    logging.info( 'END' )
    
-   if not args.no_mail:
+   if mail_info.enabled:
       smtp_conn.quit()
    
    # TODO Error no Error occurred...
@@ -19,95 +19,478 @@
 
 
 import argparse
+import calendar
+import glob
+import gzip
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--input-file", dest="input_file", type=str,
-    help="Robinhood log file.")
-parser.add_argument("-m", "--metric", dest="metric", type=str,
-    help="Metric to process e.g. a stage name or 'avg. speed'.")
 
-args = parser.parse_args()
+SUPPORTED_STAGES = ['GET_FID', 'GET_INFO_DB', 'GET_INFO_FS', 'PRE_APPLY',\
+        'DB_APPLY', 'CHGLOG_CLR', 'RM_OLD_ENTRIES']
+
+SPEED_METRIC = 'avg. speed'
+
+SUPPORTED_METRICS = SUPPORTED_STAGES + [SPEED_METRIC]
+
+# Maximum relative error of the percentiles estimated by the histogram.
+HISTOGRAM_RELATIVE_ACCURACY = 0.01
+
+PERCENTILES = [50, 90, 99]
+
+# Timestamp at the beginning of each log line.
+TIMESTAMP_FORMAT = '%Y/%m/%d %H:%M:%S'
+TIMESTAMP_LENGTH = 19
+
+BUCKET_SIZE_REG_EXP = r'^(\d+)(s|min|h|d)?$'
+BUCKET_SIZE_UNITS = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+
+class LogHistogram:
+    """Counts values in buckets growing exponentially, so a bucket covers the
+    values within a relative accuracy of its representative value.
+
+    The number of buckets only depends on the range of the values, histograms
+    with the same accuracy are merged by adding up their bucket counts."""
+
+    def __init__(self, relative_accuracy=HISTOGRAM_RELATIVE_ACCURACY):
+
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        self.buckets = dict()
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+
+        self.count += 1
+
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+
+        if other.relative_accuracy != self.relative_accuracy:
+            raise RuntimeError("Histograms of different accuracy cannot be merged!")
+
+        self.count += other.count
+        self.zero_count += other.zero_count
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def get_percentile(self, percentile):
+
+        if not self.count:
+            return None
+
+        rank = percentile / 100 * (self.count - 1)
+
+        if rank < self.zero_count:
+            return 0.0
+
+        seen = self.zero_count
+
+        for index in sorted(self.buckets):
+
+            seen += self.buckets[index]
+
+            if seen > rank:
+                # Value in the middle of the bucket by relative error.
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+class MetricAccumulator:
+    """Keeps the statistics of a metric in constant memory."""
+
+    def __init__(self):
+
+        self.items = 0
+        self.total_count = 0
+        self.sum_values = 0.0
+        self.min_value = None
+        self.max_value = None
+        self.histogram = LogHistogram()
+
+    def add(self, value, count):
+
+        self.items += 1
+        self.total_count += count
+        self.sum_values += value
+
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+
+        self.histogram.add(value)
+
+    def merge(self, other):
+
+        if not other.items:
+            return
+
+        self.items += other.items
+        self.total_count += other.total_count
+        self.sum_values += other.sum_values
+
+        if self.min_value is None or other.min_value < self.min_value:
+            self.min_value = other.min_value
+
+        if self.max_value is None or other.max_value > self.max_value:
+            self.max_value = other.max_value
+
+        self.histogram.merge(other.histogram)
+
+    def get_average(self):
+        return round(self.sum_values / self.items, 2)
+
+    def get_percentile(self, percentile):
+
+        value = self.histogram.get_percentile(percentile)
+
+        # The estimation never exceeds the observed range.
+        return round(min(max(value, self.min_value), self.max_value), 2)
+
+def parse_line(line):
+    """Returns the metric, value and count of a log line or None if the line
+    contains no value of a supported metric."""
+
+    if SPEED_METRIC in line:
+
+        result = line.split(':', 3)[3]
+        scan_speed = float(result.split('entries')[0])
+
+        return SPEED_METRIC, scan_speed, 0
+
+    # Cheap check before splitting, most lines are no stage statistics.
+    if '|' not in line:
+        return None
+
+    fields = line.split('|')
+
+    if(len(fields)) != 8:
+        return None
+
+    for stage in SUPPORTED_STAGES:
+
+        if stage in line:
+
+            count = int(fields[5])
+            value = float(fields[6])
+
+            if count and value:
+                return stage, value, count
+
+            return None
+
+    return None
+
+def parse_timestamp(timestamp):
+    """Returns the seconds since epoch of a log timestamp, which is taken
+    as UTC to have buckets of equal length across daylight saving time."""
 
-print("--- Arguments ---\nLog file: %s\nMetric: %s\n" %
-    (args.input_file, args.metric))
+    return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
 
-class ResultItem:
+def parse_bucket_size(bucket_size):
 
-    def __init__(self, value, count):
+    matched = re.match(BUCKET_SIZE_REG_EXP, bucket_size)
 
-        self.value = value
-        self.count = count
+    if not matched or not int(matched.group(1)):
+        raise RuntimeError("Invalid bucket size: %s" % bucket_size)
 
-def get_stage_values(metric, f):
+    return int(matched.group(1)) * BUCKET_SIZE_UNITS[matched.group(2) or 's']
 
-    result_items = list()
+def get_accumulators(metrics, f, bucket_size=0):
+    """Reads the log once and dispatches every line to the accumulator of
+    its metric.
+
+    Returns a dictionary of bucket start times and the accumulators of the
+    metrics in that bucket. Without a bucket size all lines are in bucket 0.
+    """
+
+    buckets = dict()
+
+    bucket = 0
+    last_timestamp = None
 
     for line in f:
 
-        if metric in line:
+        parsed = parse_line(line)
 
-            fields = line.split('|')
+        if not parsed or parsed[0] not in metrics:
+            continue
 
-            if(len(fields)) == 8:
+        if bucket_size:
 
-                count = int(fields[5])
-                value = float(fields[6])
+            timestamp = line[:TIMESTAMP_LENGTH]
 
-                if count and value:
-                    result_items.append(ResultItem(value, count))
+            # Lines of a stats block share the timestamp, so it is parsed
+            # once per block.
+            if timestamp != last_timestamp:
 
-    return result_items
+                try:
+                    bucket = parse_timestamp(timestamp) // bucket_size * \
+                        bucket_size
+                except ValueError:
+                    continue
 
+                last_timestamp = timestamp
 
-result_items = list()
+        if bucket not in buckets:
+            buckets[bucket] = dict(
+                [(metric, MetricAccumulator()) for metric in metrics])
 
-SUPPORTED_STAGES = ['GET_FID', 'GET_INFO_DB', 'GET_INFO_FS', 'PRE_APPLY',\
-        'DB_APPLY', 'CHGLOG_CLR', 'RM_OLD_ENTRIES']
+        buckets[bucket][parsed[0]].add(parsed[1], parsed[2])
+
+    return buckets
+
+def get_input_files(inputs):
+    """Returns the log files of the given files, directories or glob
+    patterns."""
+
+    input_files = list()
+
+    for pattern in inputs:
+
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name)
+                for name in sorted(os.listdir(pattern))]
+        elif os.path.exists(pattern):
+            paths = [pattern]
+        else:
+            paths = sorted(glob.glob(pattern))
+
+            if not paths:
+                raise RuntimeError("No log files found for: %s" % pattern)
+
+        input_files.extend([path for path in paths if os.path.isfile(path)])
+
+    return input_files
+
+def open_log_file(path):
+    """Opens a plain or gzip compressed log file for reading text."""
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+
+    return open(path, errors='replace')
 
-with open(args.input_file) as f:
+def get_first_timestamp(path):
+    """Returns the seconds since epoch of the first line of a log file or
+    None if it does not start with a timestamp."""
 
-    if args.metric == 'avg. speed':
+    with open_log_file(path) as f:
 
         for line in f:
 
-            if args.metric in line:
+            try:
+                return parse_timestamp(line[:TIMESTAMP_LENGTH])
+            except ValueError:
+                return None
 
-                result = line.split(':', 3)[3]
-                scan_speed = float(result.split('entries')[0])
-                result_items.append(ResultItem(scan_speed, 0))
+    return None
+
+def analyse_file(task):
+    """Returns the first timestamp, path and buckets of a log file, which are
+    merged with the partial results of the other files."""
+
+    path, metrics, bucket_size = task
+
+    with open_log_file(path) as f:
+        buckets = get_accumulators(metrics, f, bucket_size)
+
+    return get_first_timestamp(path), path, buckets
+
+def analyse_files(input_files, metrics, bucket_size, workers):
+
+    tasks = [(path, metrics, bucket_size) for path in input_files]
+
+    if workers > 1 and len(tasks) > 1:
+
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            partials = pool.map(analyse_file, tasks, chunksize=1)
 
-    elif args.metric in SUPPORTED_STAGES:
-        result_items.extend(get_stage_values(args.metric, f))
     else:
-        raise RuntimeError("Unknown or not supported metric: %s" % args.metric)
+        partials = [analyse_file(task) for task in tasks]
+
+    # Rotated logs are merged in the order of their time range regardless
+    # of their file names, files without timestamp are merged last.
+    partials.sort(key=lambda partial:
+        (partial[0] is None, partial[0] or 0, partial[1]))
+
+    return merge_buckets(metrics, [partial[2] for partial in partials])
+
+def merge_buckets(metrics, buckets_list):
+
+    merged = dict()
+
+    for buckets in buckets_list:
+
+        for bucket, accumulators in buckets.items():
 
-if result_items:
+            if bucket not in merged:
+                merged[bucket] = dict(
+                    [(metric, MetricAccumulator()) for metric in metrics])
 
-    sum_values = 0
-    total_count = 0
+            for metric in metrics:
+                merged[bucket][metric].merge(accumulators[metric])
 
-    # Initialize with first item value.
-    min_value = result_items[0].value
-    max_value = result_items[0].value
+    return merged
 
-    for item in result_items:
+def merge_accumulators(metrics, buckets):
+    """Returns the accumulators of the metrics over all buckets."""
 
-        sum_values += item.value
-        total_count += item.count
+    merged = dict([(metric, MetricAccumulator()) for metric in metrics])
 
-        if item.value < min_value:
-            min_value = item.value
+    for accumulators in buckets.values():
 
-        if item.value > max_value:
-            max_value = item.value
+        for metric in metrics:
+            merged[metric].merge(accumulators[metric])
 
-    avg = round(sum_values / len(result_items), 2)
+    return merged
+
+def write_time_series(f, metrics, buckets):
+    """Writes one line per bucket and metric with values in the bucket."""
+
+    f.write("timestamp;metric;items;average;total_count;min_value;max_value;" +
+        ';'.join(["p%d_value" % p for p in PERCENTILES]) + '\n')
+
+    for bucket in sorted(buckets):
+
+        timestamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime(bucket))
+
+        for metric in metrics:
+
+            accumulator = buckets[bucket][metric]
+
+            if accumulator.items:
+
+                f.write(';'.join([str(value) for value in
+                    [timestamp, metric, accumulator.items,
+                        accumulator.get_average(), accumulator.total_count,
+                        accumulator.min_value, accumulator.max_value] +
+                    [accumulator.get_percentile(p) for p in PERCENTILES]]) +
+                    '\n')
+
+def print_summary(accumulator):
+
+    if accumulator.items:
+
+        print("--- Results ---")
+        print("Average Speed: %s" % accumulator.get_average())
+        print("Total Count: %s" % accumulator.total_count)
+        print("Min value: %s" % accumulator.min_value)
+        print("Max value: %s" % accumulator.max_value)
+
+        for percentile in PERCENTILES:
+            print("p%d value: %s" %
+                (percentile, accumulator.get_percentile(percentile)))
+
+    else:
+        print("No result_items retrieved!")
+
+def print_summary_table(metrics, accumulators):
+
+    row_format = "%-16s %10s %12s %14s %12s %12s" + \
+        " %12s" * len(PERCENTILES)
 
     print("--- Results ---")
-    print("Average Speed: %s" % avg)
-    print("Total Count: %s" % total_count)
-    print("Min value: %s" % min_value)
-    print("Max value: %s" % max_value)
+    print(row_format %
+        tuple(["Metric", "Items", "Average", "Total Count", "Min value",
+            "Max value"] + ["p%d value" % p for p in PERCENTILES]))
+
+    for metric in metrics:
+
+        accumulator = accumulators[metric]
+
+        if accumulator.items:
+
+            print(row_format %
+                tuple([metric, accumulator.items, accumulator.get_average(),
+                    accumulator.total_count, accumulator.min_value,
+                    accumulator.max_value] +
+                    [accumulator.get_percentile(p) for p in PERCENTILES]))
+
+        else:
+            print(row_format %
+                tuple([metric, 0] + ['-'] * (4 + len(PERCENTILES))))
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input-file", dest="input_files", type=str,
+        nargs='+', help="Robinhood log files, directories or glob patterns "
+            "of plain or gzip compressed log files, their statistics are "
+            "merged.")
+    parser.add_argument("-m", "--metric", dest="metric", type=str,
+        help="Metric to process e.g. a stage name or 'avg. speed'.")
+    parser.add_argument("-a", "--all-metrics", dest="all_metrics",
+        action="store_true",
+        help="Processes all supported metrics in one pass over the log file.")
+    parser.add_argument("-b", "--bucket-size", dest="bucket_size", type=str,
+        help="Aggregates the metrics in time buckets of the given size e.g. "
+            "60, 1min, 1h or 1d and writes them as time series.")
+    parser.add_argument("-o", "--output-file", dest="output_file", type=str,
+        help="File for the time series, default is standard output.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+        default=1, help="Number of processes analysing log files in "
+            "parallel. Default: 1")
+
+    args = parser.parse_args()
+
+    bucket_size = 0
+
+    if args.bucket_size:
+        bucket_size = parse_bucket_size(args.bucket_size)
+
+    if args.all_metrics:
+        metrics = SUPPORTED_METRICS
+    elif args.metric in SUPPORTED_METRICS:
+        metrics = [args.metric]
+    else:
+        raise RuntimeError("Unknown or not supported metric: %s" % args.metric)
+
+    input_files = get_input_files(args.input_files)
+
+    if not input_files:
+        raise RuntimeError("No log files found!")
+
+    buckets = analyse_files(input_files, metrics, bucket_size, args.workers)
+
+    if bucket_size:
+
+        if args.output_file:
+
+            with open(args.output_file, 'w') as f:
+                write_time_series(f, metrics, buckets)
+
+        else:
+            write_time_series(sys.stdout, metrics, buckets)
+
+        return
+
+    print("--- Arguments ---\nLog file: %s\nMetric: %s\n" %
+        (', '.join(input_files), ', '.join(metrics)))
+
+    accumulators = merge_accumulators(metrics, buckets)
+
+    if args.all_metrics:
+        print_summary_table(metrics, accumulators)
+    else:
+        print_summary(accumulators[args.metric])
+
 
-else:
-    print("No result_items retrieved!")
+if __name__ == '__main__':
+    main()
@@ -20,144 +20,936 @@
 # Example Script Call: 
 #
 # ./rbh-set-fileclass-for-files.py -u user -p password -d database -l "{++empty_file++:size = 0},{++small_file++:size > 0 and size <= 32 KB},{++std_file++:size > 32 KB and size <= 1 GB},{++large_file++:size > 1 GB}"
+#
+# File class conditions joined by 'and':
+#
+#   size (=|<=|>=|<|>) NUMBER [B|KB|MB|GB|TB]   e.g. size > 32 KB
+#   (uid|gid) (=|!=) NAME[|NAME...]             e.g. uid = alice|bob
+#   (last_access|last_mod) age (<=|>=|<|>) NUMBER [s|min|h|d|w]   e.g. last_access age > 180 d
+#   path ^= PREFIX                              e.g. path ^= scratch/
+#
+# Path prefixes are relative to the file system root without the mount point, since Robinhood
+# keeps paths relative to the root, e.g. path ^= scratch/ matches /lustre/fs/scratch/ on /lustre/fs.
+# A path prefix may contain ' and ', since conditions are only split at an 'and' followed by another condition.
+#
+# The first matching file class is assigned, so more specific classes must be defined first.
 
 
 import logging
 import argparse
-import MySQLdb
+import threading
+import queue
+import time
 import sys
+import os
 import re
+import bisect
+import random
 
 from contextlib import closing
+from lib.entries_id_range import iter_id_ranges, get_id_range_condition, get_estimated_row_count
+
+# Classifies the sizes of a batch vectorized if available.
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+# Only required for the database, so unload files are classified without it.
+try:
+   import MySQLdb
+except ImportError:
+   MySQLdb = None
 
 
 HOST = 'localhost'
 
-FILECLASS_REG_EXP=r'^{(\+[a-zA-Z_]{1,1000}\+):((size (=|<=|>=|<|>) \d{1,2}( (B|KB|MB|GB|TB))?( and )*)+(?!size))}$'
+FILECLASS_REG_EXP=r'^(\++[a-zA-Z_]{1,1000}\++):(.+)$'
+
+SIZE_RULE_REG_EXP=r'^size\s*(=|<=|>=|<|>)\s*(\d+)(?:\s*(B|KB|MB|GB|TB))?$'
+ID_RULE_REG_EXP=r'^(uid|gid)\s*(=|!=)\s*([a-zA-Z0-9_.\-]+(?:\|[a-zA-Z0-9_.\-]+)*)$'
+AGE_RULE_REG_EXP=r'^(last_access|last_mod)\s+age\s*(<=|>=|<|>)\s*(\d+)(?:\s*(s|min|h|d|w))?$'
+PATH_RULE_REG_EXP=r'^path\s*\^=\s*(\S.*)$'
+
+# Rules are only split at an 'and' followed by the start of a rule, so path prefixes may contain ' and '.
+RULE_SEPARATOR_REG_EXP=r'\s+and\s+(?=size\s*[=<>]|(?:uid|gid)\s*!?=|(?:last_access|last_mod)\s+age\b|path\s*\^=)'
+
+# Condition of path rules on the paths computed once per entry by the derived table of the statements.
+PATH_CONDITION_PREFIX='p.path REGEXP '
 
 KB_MULTIPLIER=1024
 MB_MULTIPLIER=1048576
 GB_MULTIPLIER=1073741824
 TB_MULTIPLIER=1099511627776
 
+SIZE_MULTIPLIER_DICT={ 'B' : 1, 'KB' : KB_MULTIPLIER, 'MB' : MB_MULTIPLIER, 'GB' : GB_MULTIPLIER, 'TB' : TB_MULTIPLIER }
+
+AGE_MULTIPLIER_DICT={ 's' : 1, 'min' : 60, 'h' : 3600, 'd' : 86400, 'w' : 604800 }
+
+# An entry is older than an age, if its timestamp is before the reference time minus the age.
+AGE_OPERATOR_DICT={ '>' : '<', '>=' : '<=', '<' : '>', '<=' : '>=' }
+
+# Conditions are ordered by their costs, so cheap column comparisons short-circuit the path lookup.
+SIZE_RULE_ORDER=0
+ID_RULE_ORDER=1
+AGE_RULE_ORDER=2
+PATH_RULE_ORDER=3
+
+# Robinhood timestamp columns, that are set when an entry is modified.
+MODIFICATION_COLUMNS=[ 'last_mod', 'md_update' ]
+
+SIZE_CONDITION_REG_EXP=r'^size(=|<=|>=|<|>)(\d+)$'
+
+UNDEFINED_FILECLASS='+undefined+'
+
+CLASSIFY_BATCH_SIZE=100000
+
+# Number of rows of the primary key ranges sampled by a dry run, if no chunk size is set.
+SAMPLE_CHUNK_SIZE=10000
+
+UNLOAD_TAIL_REG_EXP=r'^Total: \d+ entries, \d+ bytes .*$'
+
+# Bounded id range for logging the statements executed per id range, the boundaries are statement parameters.
+ID_RANGE_TEMPLATE=( '<start>', '<end>' )
+
+
+def quote_sql_string( value ):
+
+   return "'" + value.replace( '\\', '\\\\' ).replace( "'", "\\'" ) + "'"
+
+
+def compile_fileclass_rule( rule, now ):
+   """Returns the cost order and the SQL condition of a single file class rule.
+
+   Conditions compare plain columns against constants, so the database can use indexes on them.
+   """
+
+   reg_exp_match = re.match( SIZE_RULE_REG_EXP, rule )
+
+   if reg_exp_match:
+
+      operator = reg_exp_match.group( 1 )
+      size     = int( reg_exp_match.group( 2 ) ) * SIZE_MULTIPLIER_DICT[ reg_exp_match.group( 3 ) or 'B' ]
+
+      # Kept without spaces, since the offline classification parses the size intervals from it.
+      return SIZE_RULE_ORDER, 'size' + operator + str( size )
+
+   reg_exp_match = re.match( ID_RULE_REG_EXP, rule )
+
+   if reg_exp_match:
+
+      column    = reg_exp_match.group( 1 )
+      name_list = reg_exp_match.group( 3 ).split( '|' )
+
+      if len( name_list ) == 1:
+
+         if reg_exp_match.group( 2 ) == '=':
+            return ID_RULE_ORDER, column + '=' + quote_sql_string( name_list[ 0 ] )
+         else:
+            return ID_RULE_ORDER, column + '<>' + quote_sql_string( name_list[ 0 ] )
+
+      sql_name_list = '(' + ','.join( [ quote_sql_string( name ) for name in name_list ] ) + ')'
+
+      if reg_exp_match.group( 2 ) == '=':
+         return ID_RULE_ORDER, column + ' IN ' + sql_name_list
+      else:
+         return ID_RULE_ORDER, column + ' NOT IN ' + sql_name_list
+
+   reg_exp_match = re.match( AGE_RULE_REG_EXP, rule )
+
+   if reg_exp_match:
+
+      column = reg_exp_match.group( 1 )
+      age    = int( reg_exp_match.group( 3 ) ) * AGE_MULTIPLIER_DICT[ reg_exp_match.group( 4 ) or 's' ]
+
+      return AGE_RULE_ORDER, column + AGE_OPERATOR_DICT[ reg_exp_match.group( 2 ) ] + str( int( now ) - age )
+
+   reg_exp_match = re.match( PATH_RULE_REG_EXP, rule )
+
+   if reg_exp_match:
+
+      prefix = reg_exp_match.group( 1 ).strip().lstrip( '/' )
+
+      # Special characters of regular expressions in the prefix are matched literally.
+      reg_exp = '^[^/]*/' + re.sub( r'([][\\.^$*+?(){}|])', r'\\\1', prefix )
+
+      # The path is built by one_path() of the Robinhood database, see create_sql_source().
+      # Its first component is the root entry in place of the mount point, so it is skipped.
+      # Statements are executed with parameters, so a literal % is doubled for the substitution by MySQLdb.
+      return PATH_RULE_ORDER, ( PATH_CONDITION_PREFIX + quote_sql_string( reg_exp ) ).replace( '%', '%%' )
+
+   raise RuntimeError( "Not supported file class rule found: " + rule )
+
+
+def get_fileclass_definitions( fileclass_list, now = None ):
+   """Returns a dictionary of file class names and their SQL conditions in definition order.
+
+   Age rules are compiled to timestamps relative to now, which is the current time if not set.
+   """
+
+   if now is None:
+      now = time.time()
 
-def get_fileclass_definitions( fileclass_list ):
-   
    fileclass_def_dict = dict()
-   
-   fileclass_input_list = fileclass_list.split( ',' )
-   
-   for fileclass_input in fileclass_input_list:
 
-      reg_exp_match = re.match( FILECLASS_REG_EXP, fileclass_input )
+   position = 0
+
+   # Classes are enclosed in braces, since path prefixes may contain commas.
+   for reg_exp_match in re.finditer( r'\{([^{}]*)\}', fileclass_list ):
+
+      if fileclass_list[ position : reg_exp_match.start() ].strip() not in ( '', ',' ):
+         raise RuntimeError( "Invalid text found between file class definitions: " + fileclass_list[ position : reg_exp_match.start() ] )
+
+      position = reg_exp_match.end()
+
+      fileclass_input = reg_exp_match.group( 1 )
 
-      if reg_exp_match == None:
-         raise RuntimeError( "The following input file class definition failed the validation: " + fileclass_input + "\n" + "Used regular expression for validation is: " + str( FILECLASS_REG_EXP ) )
-      
       logging.debug( "File class input string: " + fileclass_input )
-      
-      fileclass_name  = reg_exp_match.group(1)
-      size_definition = reg_exp_match.group(2)
-      
-      list_size_definition = size_definition.split(' ')
-      list_size_def_count  = len( list_size_definition )
-      
-      sql_size_definition = str()
-      
-      for i in range( 0, list_size_def_count ):
-         
-         item = list_size_definition[ i ]
-         
-         if ( item == 'size' ) or ( '=' in item ) or ( '<' in item ) or ( '>' in item ):
-            sql_size_definition += item
-         
-         elif item == 'and':
-            sql_size_definition += ' AND '
-         
-         elif item.isdigit():
-            
-            if i < ( list_size_def_count - 1 ):
-               
-               next_item = list_size_definition[ i + 1 ]
-               
-               if len( next_item ) == 2 and next_item[1] == 'B':
-                  
-                  size_number_prepart = int( item )
-                  
-                  if 'KB' == next_item:
-                     sql_size_definition += str( size_number_prepart * KB_MULTIPLIER )
-                  elif 'MB' == next_item:
-                     sql_size_definition += str( size_number_prepart * MB_MULTIPLIER )
-                  elif 'GB' == next_item:
-                     sql_size_definition += str( size_number_prepart * GB_MULTIPLIER )
-                  elif 'TB' == next_item:
-                     sql_size_definition += str( size_number_prepart * TB_MULTIPLIER )
-                  else:
-                     raise RuntimeError( "Found unknown unit type: " + next_item )
-                  
-                  next_item = None
-
-               elif len( next_item ) == 1 and next_item[0] == 'B':
-                  sql_size_definition += item
-               
-               else:
-                  sql_size_definition += item
-            
-            # Reached end.
-            else:
-               sql_size_definition += item
-         
-         elif len( item ) == 2 and item[1] == 'B':
+
+      class_match = re.match( FILECLASS_REG_EXP, fileclass_input )
+
+      if class_match == None:
+         raise RuntimeError( "The following input file class definition failed the validation: " + fileclass_input + "\n" + "Used regular expression for validation is: " + str( FILECLASS_REG_EXP ) )
+
+      fileclass_name = class_match.group( 1 )
+
+      if fileclass_name in fileclass_def_dict:
+         raise RuntimeError( "File class is defined more than once: " + fileclass_name )
+
+      rule_list = [ compile_fileclass_rule( rule.strip(), now ) for rule in re.split( RULE_SEPARATOR_REG_EXP, class_match.group( 2 ).strip() ) ]
+
+      sql_definition = ' AND '.join( [ sql_rule for order, sql_rule in sorted( rule_list, key=lambda rule : rule[ 0 ] ) ] )
+
+      logging.debug( "Created file class definition - name: '" + fileclass_name + "' and condition: '" + sql_definition + "'" )
+
+      fileclass_def_dict[ fileclass_name ] = sql_definition
+
+   if fileclass_list[ position : ].strip() not in ( '', ',' ):
+      raise RuntimeError( "Invalid text found after file class definitions: " + fileclass_list[ position : ] )
+
+   if len( fileclass_def_dict ) == 0:
+      raise RuntimeError( 'No file class definition found!' )
+
+   return fileclass_def_dict
+
+
+def has_age_rule( fileclass_def_dict ):
+
+   return any( [ re.search( r'\b(last_access|last_mod)(<=|>=|<|>)', sql_definition ) for sql_definition in fileclass_def_dict.values() ] )
+
+
+class SizeClassifier:
+   """Classifies file sizes by the sorted boundaries of the size intervals of the file class definitions.
+
+   Like the CASE expression of the update, the first matching file class in definition order is taken.
+   """
+
+   def __init__( self, fileclass_def_dict ):
+
+      self.fileclass_list = list( fileclass_def_dict.keys() ) + [ UNDEFINED_FILECLASS ]
+
+      undefined_index = len( self.fileclass_list ) - 1
+
+      interval_list = [ get_size_interval( size_definition ) for size_definition in fileclass_def_dict.values() ]
+
+      boundary_set = set()
+
+      for lower, upper in interval_list:
+
+         boundary_set.add( lower )
+
+         if upper is not None:
+            boundary_set.add( upper )
+
+      self.boundary_list = sorted( boundary_set )
+
+      # Class index of each interval between two boundaries, the first one is for sizes below the lowest boundary.
+      self.index_list = [ undefined_index ]
+
+      for boundary in self.boundary_list:
+
+         index = undefined_index
+
+         for i, ( lower, upper ) in enumerate( interval_list ):
+
+            if lower <= boundary and ( upper is None or boundary < upper ):
+               index = i
+               break
+
+         self.index_list.append( index )
+
+      if numpy:
+         self.boundary_array = numpy.array( self.boundary_list, dtype=numpy.int64 )
+         self.index_array    = numpy.array( self.index_list, dtype=numpy.int64 )
+
+   def classify( self, size_list ):
+      """Returns the file class indexes of the sizes, as NumPy array if NumPy is available."""
+
+      if numpy:
+         return self.index_array[ numpy.searchsorted( self.boundary_array, numpy.array( size_list, dtype=numpy.int64 ), side='right' ) ]
+
+      return [ self.index_list[ bisect.bisect_right( self.boundary_list, size ) ] for size in size_list ]
+
+
+class FileclassStatistics:
+
+   def __init__( self, fileclass_list ):
+
+      self.fileclass_list = fileclass_list
+      self.file_count_list = [ 0 ] * len( fileclass_list )
+      self.byte_count_list = [ 0 ] * len( fileclass_list )
+
+   def add( self, index_list, size_list ):
+
+      if numpy:
+
+         index_array = numpy.asarray( index_list )
+         size_array  = numpy.array( size_list, dtype=numpy.int64 )
+
+         for i in range( len( self.fileclass_list ) ):
+
+            mask = index_array == i
+
+            # Summed up as Python integers, which do not overflow.
+            self.file_count_list[ i ] += int( numpy.count_nonzero( mask ) )
+            self.byte_count_list[ i ] += int( size_array[ mask ].sum() )
+
+      else:
+
+         for index, size in zip( index_list, size_list ):
+            self.file_count_list[ index ] += 1
+            self.byte_count_list[ index ] += size
+
+   def get_list( self ):
+      """Returns a list of ( fileclass, files, bytes ) tuples of the file classes with files."""
+
+      return [ ( self.fileclass_list[ i ], self.file_count_list[ i ], self.byte_count_list[ i ] ) for i in range( len( self.fileclass_list ) ) if self.file_count_list[ i ] ]
+
+
+class Progress:
+
+   def __init__( self, num_chunks, interval ):
+
+      self.num_chunks = num_chunks
+      self.interval   = interval
+
+      self.lock             = threading.Lock()
+      self.start_time       = time.time()
+      self.last_report_time = self.start_time
+
+      self.chunk_count        = 0
+      self.failed_chunk_count = 0
+      self.examined_row_count = 0
+      self.row_count          = 0
+
+   def add_chunk( self, examined_rows, rows ):
+
+      with self.lock:
+
+         self.chunk_count        += 1
+         self.examined_row_count += examined_rows
+         self.row_count          += rows
+
+         if self.interval and time.time() - self.last_report_time >= self.interval:
+            self.report()
+
+   def add_failed_chunk( self ):
+
+      with self.lock:
+         self.failed_chunk_count += 1
+
+   def report( self ):
+
+      self.last_report_time = time.time()
+
+      elapsed_time = self.last_report_time - self.start_time
+
+      rows_per_second = 0
+
+      if elapsed_time > 0:
+         rows_per_second = self.examined_row_count / elapsed_time
+
+      # The number of chunks is estimated from the table statistics.
+      logging.info( "Progress - chunks done: %d of about %d - failed chunks: %d - examined rows: %d - changed rows: %d - examined rows/s: %.1f" % ( self.chunk_count, self.num_chunks, self.failed_chunk_count, self.examined_row_count, self.row_count, rows_per_second ) )
+
+
+class ChunkWorkerThread( threading.Thread ):
+
+   def __init__( self, range_queue, chunk_size, fileclass_def_dict, since, progress, conn ):
+
+      threading.Thread.__init__( self )
+
+      self.range_queue        = range_queue
+      self.chunk_size         = chunk_size
+      self.fileclass_def_dict = fileclass_def_dict
+      self.since              = since
+      self.progress           = progress
+      self.conn               = conn
+
+   def run( self ):
+
+      logging.debug( "Thread '%s' started!" % self.name )
+
+      try:
+
+         with closing( self.conn ):
+
+            with closing( self.conn.cursor() ) as cur:
+
+               while True:
+
+                  id_range = self.range_queue.get()
+
+                  if id_range is None:
+                     break
+
+                  self.update_chunk( cur, id_range )
+
+      except Exception as e:
+         logging.error( "Caught exception in thread ('%s') with error message:\n%s" % ( self.name, str( e ) ) )
+
+      logging.debug( "Thread '%s' finished!" % self.name )
+
+   def update_chunk( self, cur, id_range ):
+
+      condition, params = get_id_range_condition( id_range[ 0 ], id_range[ 1 ] )
+
+      sql_update, update_params = create_sql_update( self.fileclass_def_dict, self.since, id_range )
+
+      try:
+
+         # Ranges are read with chunk size rows, only the size of the open ended last range is unknown.
+         examined_rows = self.chunk_size
+
+         if id_range[ 1 ] is None:
+            cur.execute( 'SELECT COUNT(*) FROM ENTRIES WHERE ' + condition, params )
+            examined_rows = int( cur.fetchone()[ 0 ] )
+
+         cur.execute( sql_update, update_params )
+
+         logging.debug( "Examined rows in id range %s: %d - changed rows: %d" % ( str( id_range ), examined_rows, cur.rowcount ) )
+
+         self.progress.add_chunk( examined_rows, cur.rowcount )
+
+      except Exception as e:
+
+         logging.error( "Caught exception during update of id range %s in thread ('%s') with error message:\n%s" % ( str( id_range ), self.name, str( e ) ) )
+
+         self.progress.add_failed_chunk()
+
+
+def get_size_interval( size_definition ):
+   """Returns the half-open interval ( lower, upper ) of sizes matching a size definition, upper is None if unlimited."""
+
+   lower = 0
+   upper = None
+
+   for condition in size_definition.split( ' AND ' ):
+
+      reg_exp_match = re.match( SIZE_CONDITION_REG_EXP, condition )
+
+      if reg_exp_match == None:
+         raise RuntimeError( "Only size conditions are supported for classifying unload files, found: " + condition )
+
+      operator = reg_exp_match.group( 1 )
+      number   = int( reg_exp_match.group( 2 ) )
+
+      # File sizes are integers, so every condition is expressed by an inclusive lower and exclusive upper bound.
+      if operator in ( '=', '>=' ):
+         lower = max( lower, number )
+      elif operator == '>':
+         lower = max( lower, number + 1 )
+
+      if operator in ( '=', '<=' ):
+         upper = number + 1 if upper is None else min( upper, number + 1 )
+      elif operator == '<':
+         upper = number if upper is None else min( upper, number )
+
+   return lower, upper
+
+
+def classify_unload_file( path, classifier, statistics, writer = None ):
+   """Classifies the files of an rbh-report CSV unload by their size, annotated lines are written to the writer if set.
+
+   Returns the number of classified files.
+   """
+
+   size_index  = None
+   found_tail  = False
+   file_count  = 0
+   line_number = 0
+
+   size_list = list()
+   line_list = list()
+
+   def flush():
+
+      index_list = classifier.classify( size_list )
+
+      statistics.add( index_list, size_list )
+
+      if writer:
+
+         for index, line in zip( index_list, line_list ):
+            writer.write( classifier.fileclass_list[ index ] + ', ' + line )
+
+      del size_list[:]
+      del line_list[:]
+
+   with open( path, 'r', encoding='utf8', errors='replace' ) as reader:
+
+      for line in reader:
+
+         line_number += 1
+
+         if size_index is None:
+
+            column_list = [ column.strip() for column in line.split( ',' ) ]
+
+            # Only columns in front of the path can be split by comma, since paths may contain commas.
+            if 'type' in column_list and 'size' in column_list and 'path' in column_list and column_list.index( 'size' ) < column_list.index( 'path' ):
+
+               size_index = column_list.index( 'size' )
+               type_index = column_list.index( 'type' )
+               max_split  = max( size_index, type_index ) + 1
+
+               if writer:
+                  writer.write( 'fileclass, ' + line )
+
             continue
 
-         elif len( item ) == 1 and item[0] == 'B':
+         if not line.strip():
             continue
-         
-         else:
-            raise RuntimeError( "Not supported string found: " + item )
-      
-      logging.debug( "Created file class definition - name: '" + fileclass_name + "' and size: '" + sql_size_definition + "'" )
-      
-      fileclass_def_dict[ fileclass_name ] = sql_size_definition
-   
-   return fileclass_def_dict
 
+         if re.match( UNLOAD_TAIL_REG_EXP, line ):
+            found_tail = True
+            break
+
+         field_list = line.split( ',', max_split )
+
+         try:
+            size = int( field_list[ size_index ] )
+         except ( IndexError, ValueError ):
+            logging.error( "Invalid line (%d) in unload file %s: %s" % ( line_number, path, line.rstrip() ) )
+            continue
+
+         if field_list[ type_index ].strip() != 'file':
+            continue
+
+         size_list.append( size )
+
+         if writer:
+            line_list.append( line )
+
+         file_count += 1
+
+         if len( size_list ) == CLASSIFY_BATCH_SIZE:
+            flush()
+
+   flush()
+
+   if size_index is None:
+      raise RuntimeError( "No header found in unload file: " + path )
+
+   if not found_tail:
+      logging.error( "No tail found in unload file: " + path )
+
+   return file_count
+
+
+def classify_unload_files( path_list, fileclass_def_dict, output_file = None ):
+
+   classifier = SizeClassifier( fileclass_def_dict )
+   statistics = FileclassStatistics( classifier.fileclass_list )
+
+   writer = None
+
+   if output_file:
+      writer = open( output_file, 'w', encoding='utf8' )
+
+   try:
+
+      for path in path_list:
+
+         start_time = time.time()
+
+         file_count = classify_unload_file( path, classifier, statistics, writer )
+
+         elapsed_time = time.time() - start_time
+
+         logging.info( "Classified files: %d in %.2f seconds from unload file: %s" % ( file_count, elapsed_time, path ) )
+
+   finally:
+
+      if writer:
+         writer.close()
+
+   return statistics.get_list()
+
+
+def create_sql_case( fileclass_def_dict ):
+   """Returns the CASE expression computing the file class of an entry."""
 
-def update_database( cur, fileclass_def_dict ):
-   
    if len( fileclass_def_dict ) == 0:
       raise RuntimeError( 'Empty file class definition dictionary!' )
+
+   sql_case = 'CASE\n'
+
+   for name in fileclass_def_dict.keys():
+      sql_case += 'WHEN ' + fileclass_def_dict[name] + " THEN '" + name + "'\n"
+
+   sql_case += 'ELSE fileclass = \'+undefined+\'\nEND'
+
+   return sql_case
+
+
+def create_sql_since_condition( since ):
+   """Returns the condition matching entries modified at or after the epoch timestamp since."""
+
+   return "( " + " OR ".join( [ column + " >= " + str( int( since ) ) for column in MODIFICATION_COLUMNS ] ) + " )"
+
+
+def create_sql_class_condition( fileclass_def_dict, since = None ):
+   """Returns the condition matching the entries of all file classes.
+
+   If since is set, only entries modified at or after that epoch timestamp are matched.
+   """
+
+   sql_condition = "(\n" + " OR\n".join( [ "( " + size + " )" for size in fileclass_def_dict.values() ] ) + "\n)"
+
+   if since is not None:
+      sql_condition += "\nAND " + create_sql_since_condition( since )
+
+   return sql_condition
+
+
+def create_sql_change_condition( fileclass_def_dict ):
+   """Returns the condition matching entries, whose stored file class differs from the computed one."""
+
+   # The NULL-safe comparison also matches entries without any file class.
+   return "NOT ( fileclass <=> " + create_sql_case( fileclass_def_dict ) + " )"
+
+
+def create_sql_condition( fileclass_def_dict, since = None ):
+   """Returns the condition matching the entries of all file classes, whose stored file class differs from the computed one."""
+
+   # Rows that already have the right file class are skipped instead of being rewritten with the same value.
+   return create_sql_class_condition( fileclass_def_dict, since ) + "\nAND " + create_sql_change_condition( fileclass_def_dict )
+
+
+def get_path_filter_condition( fileclass_def_dict ):
+   """Returns the condition selecting the entries, whose path is needed by the path rule of a file class.
+
+   None is returned if no file class has a path rule and an empty string if the paths of all entries are needed.
+   """
+
+   condition_list = list()
+
+   for sql_definition in fileclass_def_dict.values():
+
+      index = sql_definition.find( PATH_CONDITION_PREFIX )
+
+      if index == -1:
+         continue
+
+      if index == 0:
+         return ''
+
+      # Path rules are ordered last, so the rules in front of them select the entries of the class needing a path.
+      condition_list.append( "( " + sql_definition[ : index ].rstrip()[ : -len( 'AND' ) ].rstrip() + " )" )
+
+   if not condition_list:
+      return None
+
+   return "(\n" + " OR\n".join( condition_list ) + "\n)"
+
+
+def create_sql_source( fileclass_def_dict, since = None, id_range = None ):
+   """Returns the optimizer hint, the table expression and its parameters of the statements on ENTRIES aliased as e.
+
+   If a file class has a path rule, ENTRIES is joined with the derived table p of the paths of the entries in the id range,
+   so one_path() is called once per entry instead of once per path rule in the WHERE clause, the change condition and the CASE expression.
+   """
+
+   path_filter_condition = get_path_filter_condition( fileclass_def_dict )
+
+   if path_filter_condition is None:
+      return '', 'ENTRIES e', ()
+
+   condition_list = list()
+   params         = ()
+
+   if id_range:
+      condition, params = get_id_range_condition( id_range[ 0 ], id_range[ 1 ] )
+      condition_list.append( condition )
+
+   if since is not None:
+      condition_list.append( create_sql_since_condition( since ) )
+
+   if path_filter_condition:
+      condition_list.append( path_filter_condition )
+
+   sql_source = "ENTRIES e LEFT JOIN (\nSELECT id, one_path(id) AS path FROM ENTRIES"
+
+   if condition_list:
+      sql_source += "\nWHERE " + "\nAND ".join( condition_list )
+
+   # Entries left out of the derived table get a NULL path, which matches no path rule.
+   sql_source += "\n) p ON p.id = e.id"
+
+   # The derived table is kept materialized, so its one_path() calls are not merged into the conditions of the outer statement.
+   return '/*+ NO_MERGE(p) */ ', sql_source, params
+
+
+def create_sql_update( fileclass_def_dict, since = None, id_range = None ):
+   """Returns the UPDATE statement setting the file class by a CASE expression and its parameters, restricted to the id range if set."""
+
+   sql_hint, sql_source, params = create_sql_source( fileclass_def_dict, since, id_range )
+
+   sql = 'UPDATE ' + sql_hint + sql_source + '\nSET e.fileclass =\n' + create_sql_case( fileclass_def_dict ) + '\nWHERE '
+
+   if id_range:
+      condition, range_params = get_id_range_condition( id_range[ 0 ], id_range[ 1 ], 'e.id' )
+      sql    += condition + ' AND '
+      params += range_params
+
+   return sql + '(\n' + create_sql_condition( fileclass_def_dict, since ) + '\n)', params
+
+
+def create_sql_distribution_select( fileclass_def_dict, since = None, id_range = None ):
+   """Returns the SELECT statement of files, bytes and changed files per file class and its parameters, restricted to the id range if set."""
+
+   sql_hint, sql_source, params = create_sql_source( fileclass_def_dict, since, id_range )
+
+   sql = "SELECT " + sql_hint + create_sql_case( fileclass_def_dict ) + " AS new_fileclass, COUNT(*), SUM(size), SUM(" + create_sql_change_condition( fileclass_def_dict ) + ")\n" \
+         "FROM " + sql_source + "\nWHERE "
+
+   if id_range:
+      condition, range_params = get_id_range_condition( id_range[ 0 ], id_range[ 1 ], 'e.id' )
+      sql    += condition + " AND "
+      params += range_params
+
+   return sql + create_sql_class_condition( fileclass_def_dict, since ) + "\nGROUP BY new_fileclass", params
+
+
+def read_high_water_mark( path ):
+   """Returns the high-water mark stored by the last successful run or None if there is none."""
+
+   if not path or not os.path.isfile( path ):
+      return None
+
+   with open( path, 'r' ) as f:
+      return int( f.read().strip() )
+
+
+def write_high_water_mark( path, high_water_mark ):
+
+   temp_path = path + '.tmp'
+
+   with open( temp_path, 'w' ) as f:
+      f.write( str( high_water_mark ) + '\n' )
+
+   # Replaced atomically, so an interrupted write does not lose the previous high-water mark.
+   os.replace( temp_path, path )
+
+
+def get_database_time( cur ):
+
+   # Robinhood sets md_update with the clock of its own host, which is usually the database host.
+   cur.execute( 'SELECT UNIX_TIMESTAMP()' )
+
+   return int( cur.fetchone()[ 0 ] )
+
+
+def estimate_fileclass_distribution( cur, fileclass_def_dict, since = None, sample_ratio = None, chunk_size = SAMPLE_CHUNK_SIZE ):
+   """Returns a list of ( fileclass, files, bytes, changed files ) tuples sorted by file class.
+
+   With a sample ratio only that share of the primary key ranges of chunk size rows is aggregated and the numbers are scaled up accordingly.
+   """
+
+   # MySQL returns the sums as DECIMAL, so all numbers are converted to integers.
+   distribution_dict = dict()
+
+   def aggregate( id_range ):
+
+      cur.execute( *create_sql_distribution_select( fileclass_def_dict, since, id_range ) )
+
+      for row in cur.fetchall():
+
+         distribution = distribution_dict.setdefault( row[ 0 ], [ 0, 0, 0 ] )
+
+         distribution[ 0 ] += int( row[ 1 ] )
+         distribution[ 1 ] += int( row[ 2 ] or 0 )
+         distribution[ 2 ] += int( row[ 3 ] or 0 )
+
+   if not sample_ratio:
+
+      logging.debug( "Executing SQL select statement:\n" + create_sql_distribution_select( fileclass_def_dict, since )[ 0 ] )
+
+      aggregate( None )
+
+      return sorted( [ ( fileclass, ) + tuple( distribution ) for fileclass, distribution in distribution_dict.items() ] )
+
+   logging.debug( "Executing SQL select statement per sampled id range:\n" + create_sql_distribution_select( fileclass_def_dict, since, ID_RANGE_TEMPLATE )[ 0 ] )
+
+   # Every n-th range from a random start is read, so skipped ranges are neither scanned nor classified.
+   stride = max( 1, int( round( 1 / sample_ratio ) ) )
+   offset = random.randrange( stride )
+
+   range_count   = 0
+   sampled_count = 0
+   id_range      = None
+
+   for i, id_range in enumerate( iter_id_ranges( cur, chunk_size ) ):
+
+      range_count += 1
+
+      if i % stride == offset:
+
+         aggregate( id_range )
+
+         sampled_count += 1
+
+   # Tables with fewer ranges than the stride are aggregated from their last range.
+   if id_range is not None and not sampled_count:
+
+      aggregate( id_range )
+
+      sampled_count = 1
+
+   logging.info( "Sampled id ranges: %d of %d" % ( sampled_count, range_count ) )
+
+   distribution_list = list()
+
+   for fileclass, distribution in distribution_dict.items():
+      distribution_list.append( ( fileclass, ) + tuple( [ number * range_count // sampled_count for number in distribution ] ) )
+
+   return sorted( distribution_list )
+
+
+def print_fileclass_distribution( distribution_list ):
+
+   print( "fileclass;files;bytes;changed_files" )
+
+   for distribution in distribution_list:
+      print( "%s;%d;%d;%d" % distribution )
+
+
+def print_fileclass_statistics( statistics_list ):
+
+   print( "fileclass;files;bytes" )
+
+   for statistics in statistics_list:
+      print( "%s;%d;%d" % statistics )
+
+
+def update_database( cur, fileclass_def_dict, since = None ):
    
-   names = fileclass_def_dict.keys()
-   sizes = fileclass_def_dict.values()
-   
-   sql_update = 'UPDATE ENTRIES SET fileclass ='
-   
-# [START] - SQL CASE STATEMENT
-   sql_update += '\nCASE\n'
-   
-   for name in names:
-      sql_update += 'WHEN ' + fileclass_def_dict[name] + " THEN '" + name + "'\n"
-   
-   sql_update += 'ELSE fileclass = \'+undefined+\'\nEND\n'
-# [END] - SQL CASE STATEMENT
-   
-# [START] - SQL WHERE CLAUSE
-   sql_update += 'WHERE\n'
-   
-   sql_update += "( " + sizes[ 0 ] + " )"
-   
-   if len( sizes ) > 1:
-      
-      for i in range( 1, len( sizes ) ):
-         sql_update += " OR\n( " + sizes[ i ] + " )"
-# [END] - SQL WHERE CLAUSE
+   sql_update, params = create_sql_update( fileclass_def_dict, since )
    
    logging.debug( "Executing SQL update statement:\n" + sql_update )
    
-   cur.execute( sql_update )
+   # Executed with parameters like the chunked update, even if empty, so doubled % of path rules are substituted.
+   cur.execute( sql_update, params )
    
-   logging.info( "Updated rows: " + str ( cur.rowcount ) )
+   changed_rows = cur.rowcount
+
+   # A single statement examines the complete table, so its row count is taken from the table statistics.
+   logging.info( "Examined rows (estimated): " + str( get_estimated_row_count( cur ) ) + " - Changed rows: " + str ( changed_rows ) )
+
+   return True
+
+
+def put_range( range_queue, id_range, thread_handles ):
+   """Returns False if the id range could not be queued, since all workers stopped."""
+
+   while True:
+
+      try:
+         range_queue.put( id_range, timeout=1 )
+         return True
+
+      except queue.Full:
+
+         if not any( [ th_handle.is_alive() for th_handle in thread_handles ] ):
+            return False
+
+
+def update_database_chunked( cur, fileclass_def_dict, since, chunk_size, workers, progress_interval, host, username, password, database ):
+   """Returns False if the update of any chunk failed."""
+
+   logging.debug( "Executing SQL update statement per id range:\n" + create_sql_update( fileclass_def_dict, since, ID_RANGE_TEMPLATE )[ 0 ] )
+
+   progress = Progress( -( -get_estimated_row_count( cur ) // chunk_size ), progress_interval )
+
+   # Opened before any id range is read, so a refused connection stops the run instead of leaving ranges without a worker.
+   conn_list = list()
+
+   try:
+
+      for i in range( workers ):
+
+         conn = MySQLdb.connect( host=host, user=username, passwd=password, db=database )
+         conn_list.append( conn )
+
+         # Each chunk is committed on its own, so row locks are held only for a chunk.
+         conn.autocommit( True )
+
+   except Exception:
+
+      for conn in conn_list:
+         conn.close()
+
+      raise
+
+   # Bounded, so the boundaries of the id ranges are read only shortly before they are updated.
+   range_queue = queue.Queue( workers * 2 )
+
+   thread_handles = list()
+
+   for conn in conn_list:
+
+      th_handle = ChunkWorkerThread( range_queue, chunk_size, fileclass_def_dict, since, progress, conn )
+      th_handle.start()
+
+      thread_handles.append( th_handle )
+
+   try:
+
+      for id_range in iter_id_ranges( cur, chunk_size ):
+
+         if not put_range( range_queue, id_range, thread_handles ):
+            logging.error( 'All workers stopped, the remaining id ranges are not updated.' )
+            progress.add_failed_chunk()
+            break
+
+   finally:
+
+      for th_handle in thread_handles:
+
+         if not put_range( range_queue, None, thread_handles ):
+            break
+
+      for th_handle in thread_handles:
+
+         logging.debug( "Joining thread: '%s'" % th_handle.name )
+
+         th_handle.join()
+
+      # Ranges left behind by stopped workers were not updated.
+      while not range_queue.empty():
+
+         if range_queue.get_nowait() is not None:
+            progress.add_failed_chunk()
+
+   with progress.lock:
+      progress.report()
+
+   if progress.failed_chunk_count:
+      logging.error( "Updating %d chunks failed, the file classes of their entries might not be up to date." % progress.failed_chunk_count )
+      return False
+
+   return True
 
 
 def main():
@@ -166,16 +958,43 @@ def main():
 
    logging.info( 'START' )
 
-   parser = argparse.ArgumentParser( description='Sets file classes for files according to a specified size. A file size is supported from bytes up to TB specification.' )
+   parser = argparse.ArgumentParser( description='Sets file classes for files according to rules on size, owner, age and path. A file size is supported from bytes up to TB specification.' )
 
-   parser.add_argument( '-u', '--username',       dest='username',       type=str, required=True,  help='Username for the Robinhood Database.' )
-   parser.add_argument( '-p', '--password',       dest='password',       type=str, required=True,  help='Password for the Robinhood Database.' )
+   parser.add_argument( '-u', '--username',       dest='username',       type=str, required=False, help='Username for the Robinhood Database, required unless unload files are classified.' )
+   parser.add_argument( '-p', '--password',       dest='password',       type=str, required=False, help='Password for the Robinhood Database, required unless unload files are classified.' )
    parser.add_argument( '-H', '--host',           dest='host',           type=str, required=False, help='Database Host.', default=HOST )
-   parser.add_argument( '-d', '--database',       dest='database',       type=str, required=True,  help='Robinhood Database.' )
-   parser.add_argument( '-l', '--fileclass-list', dest='fileclass_list', type=str, required=True,  help='Definition of file classes in the format: {fileclass:size definition},{...} e.g. {++empty_file++:size = 0},{++small_file++:size > 0 and size <= 32 KB},{++std_file++:size > 32 KB and size <= 1 GB},{++large_file++:size > 1 GB}' )
+   parser.add_argument( '-d', '--database',       dest='database',       type=str, required=False, help='Robinhood Database, required unless unload files are classified.' )
+   parser.add_argument( '-l', '--fileclass-list', dest='fileclass_list', type=str, required=True,  help='Definition of file classes in the format: {fileclass:rule and rule ...},{...} e.g. {++empty_file++:size = 0},{++small_file++:size > 0 and size <= 32 KB},{++std_file++:size > 32 KB and size <= 1 GB},{++large_file++:size > 1 GB}, rules on uid, gid, last_access age, last_mod age and path are described in the script header.' )
+   parser.add_argument( '-c', '--chunk-size',     dest='chunk_size',     type=int, required=False, help='Updates ENTRIES in primary key ranges of the given number of rows with a commit per range, 0 updates all entries in one statement.', default=0 )
+   parser.add_argument( '-w', '--workers',        dest='workers',        type=int, required=False, help='Number of parallel database connections updating the primary key ranges.', default=4 )
+   parser.add_argument( '--progress-interval',    dest='progress_interval', type=int, required=False, help='Seconds between progress reports of chunked updates, 0 reports only at the end.', default=60 )
+   parser.add_argument( '-s', '--state-file',     dest='state_file',     type=str, required=False, help='File keeping the modification high-water mark of the last successful run, only entries modified since then are reclassified.' )
+   parser.add_argument( '--overlap',              dest='overlap',        type=int, required=False, help='Seconds subtracted from the high-water mark to cover clock differences and entries modified during the last run.', default=600 )
+   parser.add_argument( '--full',                 dest='full',           required=False, action='store_true', help='Reclassifies all entries regardless of the high-water mark, which is then set anew.' )
+   parser.add_argument( '--dry-run',              dest='dry_run',        required=False, action='store_true', help='Prints the number of files, bytes and changed files per file class instead of updating the database.' )
+   parser.add_argument( '-x', '--unload-file',    dest='unload_files',   type=str, required=False, action='append', help='Classifies the files of an rbh-report CSV unload instead of the database and prints files and bytes per file class, can be set several times.' )
+   parser.add_argument( '-o', '--output-file',    dest='output_file',    type=str, required=False, help='Writes the lines of the unload files prefixed with their file class to the given file.' )
+   parser.add_argument( '--sample-ratio',         dest='sample_ratio',   type=float, required=False, help='Estimates the dry run numbers from the given share of primary key ranges, e.g. 0.01. Ranges are of chunk size rows if set, otherwise of ' + str( SAMPLE_CHUNK_SIZE ) + ' rows.' )
    args = parser.parse_args()
 
+   if args.sample_ratio is not None and not 0 < args.sample_ratio <= 1:
+      raise RuntimeError( 'Sample ratio must be greater than 0 and at most 1!' )
+
    fileclass_def_dict = get_fileclass_definitions( args.fileclass_list )
+
+   if args.unload_files:
+
+      print_fileclass_statistics( classify_unload_files( args.unload_files, fileclass_def_dict, args.output_file ) )
+
+      logging.info( 'END' )
+
+      return 0
+
+   if not args.username or not args.password or not args.database:
+      raise RuntimeError( 'Username, password and database must be set for updating the Robinhood database!' )
+
+   if MySQLdb is None:
+      raise RuntimeError( 'Python module MySQLdb must be installed for updating the Robinhood database!' )
    
    with closing( MySQLdb.connect( host=args.host, user=args.username, passwd=args.password, db=args.database ) ) as conn:
 
@@ -183,9 +1002,41 @@ def main():
 
          conn.autocommit( True )
 
-         update_database( cur, fileclass_def_dict )
+         since = None
+
+         if not args.full:
+
+            high_water_mark = read_high_water_mark( args.state_file )
+
+            if high_water_mark is not None:
+               since = high_water_mark - args.overlap
+
+         if since is None:
+            logging.info( 'Reclassifying all entries.' )
+         else:
+            logging.info( "Reclassifying entries modified since: %d" % since )
+
+            if has_age_rule( fileclass_def_dict ):
+               logging.warning( 'Entries aging into another file class without being modified are only reclassified with --full.' )
+
+         if args.dry_run:
+
+            print_fileclass_distribution( estimate_fileclass_distribution( cur, fileclass_def_dict, since, args.sample_ratio, args.chunk_size or SAMPLE_CHUNK_SIZE ) )
+
+            logging.info( 'END' )
+
+            return 0
+
+         # Taken before the update, so entries modified during the run are included in the next one.
+         next_high_water_mark = get_database_time( cur )
+
+         if args.chunk_size:
+            is_complete = update_database_chunked( cur, fileclass_def_dict, since, args.chunk_size, args.workers, args.progress_interval, args.host, args.username, args.password, args.database )
+         else:
+            is_complete = update_database( cur, fileclass_def_dict, since )
 
-   update_database( None, fileclass_def_dict )
+         if args.state_file and is_complete:
+            write_high_water_mark( args.state_file, next_high_water_mark )
    
    logging.info( 'END' )
    
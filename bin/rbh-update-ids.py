@@ -18,32 +18,446 @@
 #
 
 
-# QUICK SOLUTION TO FIX PARALLEL UPDATES ON DATABASE (NOT OPTIMIZED SOLUTION!!!)
-# TODO: IMPROVE PARALLEL UPDATES WITH SHARED TASK QUEUE...
-
-
 import logging
 import argparse
 import threading
+import queue
+import time
 import MySQLdb
 import pwd
 import grp
+import os
 
 from contextlib import closing
+from lib.entries_id_range import iter_id_ranges, get_id_range_condition, get_estimated_row_count
+from lib.entries_table_handler import decode_column
 
 
 HOST = 'localhost'
 
+REPLICATION_POLL_SECONDS = 5
+
+STATUS_COMPLETED = 'COMPLETED'
+STATUS_ROLLED_BACK = 'ROLLED_BACK'
+STATUS_FAILED = 'FAILED'
+
+# Pairs with rows of already committed chunks, the remaining rows are updated on restart.
+STATUS_PARTIAL = 'PARTIAL'
+
+STATUS_LIST = [STATUS_COMPLETED, STATUS_ROLLED_BACK, STATUS_FAILED, STATUS_PARTIAL]
+
+# Ranges of the id range scheduler per worker.
+RANGES_PER_WORKER = 8
+
+# Ends a worker of the id range scheduler, since None stands for the complete table.
+STOP_MARKER = 'STOP'
+
+# Joined on the uid/gid pair, so only the resolved pairs are translated and not every combination of their uids and gids.
+MAPPING_JOIN = "ENTRIES e JOIN PAIR_MAPPING pm ON e.uid = pm.uid AND e.gid = pm.gid"
+
+# MySQL error codes of lock wait timeouts and deadlocks.
+LOCK_ERROR_CODES = (1205, 1213)
+
+
+class IdResolver:
+
+   def __init__(self, preload):
+
+      self.lock = threading.Lock()
+
+      # Unresolvable ids are cached with None.
+      self.user_map = dict()
+      self.group_map = dict()
+
+      if preload:
+
+         for entry in pwd.getpwall():
+            self.user_map.setdefault(entry.pw_uid, entry.pw_name)
+
+         for entry in grp.getgrall():
+            self.group_map.setdefault(entry.gr_gid, entry.gr_name)
+
+         logging.debug("Preloaded users: %d - groups: %d" % (len(self.user_map), len(self.group_map)))
+
+   def get_user(self, uid):
+      return self._lookup(self.user_map, int(uid), lambda key: pwd.getpwuid(key).pw_name)
+
+   def get_group(self, gid):
+      return self._lookup(self.group_map, int(gid), lambda key: grp.getgrgid(key).gr_name)
+
+   def get_unresolved_uid_list(self):
+      return sorted([uid for uid, name in self.user_map.items() if name is None])
+
+   def get_unresolved_gid_list(self):
+      return sorted([gid for gid, name in self.group_map.items() if name is None])
+
+   def _lookup(self, id_map, key, lookup):
+
+      with self.lock:
+
+         if key in id_map:
+            return id_map[key]
+
+      # Ids missing in the preloaded databases are looked up on their own,
+      # since name services may not enumerate all entries.
+      try:
+         name = lookup(key)
+      except KeyError:
+         name = None
+
+      with self.lock:
+         id_map[key] = name
+
+      return name
+
+
+class Throttle:
+
+   def __init__(self, max_rows_per_second, max_replication_lag, replica_host, username, password):
+
+      self.max_rows_per_second = max_rows_per_second
+      self.max_replication_lag = max_replication_lag
+
+      self.lock = threading.Lock()
+      self.start_time = time.time()
+      self.row_count = 0
+
+      self.replica_lock = threading.Lock()
+      self.replica_conn = None
+
+      if max_replication_lag:
+         self.replica_conn = MySQLdb.connect(host=replica_host, user=username, passwd=password)
+
+   def close(self):
+
+      if self.replica_conn:
+         self.replica_conn.close()
+
+   def wait(self, rows):
+
+      delay = 0
+
+      # The rate limit applies to the rows updated by all workers together.
+      if self.max_rows_per_second:
+
+         with self.lock:
+
+            self.row_count += rows
+            delay = self.row_count / self.max_rows_per_second - (time.time() - self.start_time)
+
+      if delay > 0:
+         time.sleep(delay)
+
+      if self.max_replication_lag:
+
+         while True:
+
+            replication_lag = self.get_replication_lag()
+
+            if replication_lag is not None and replication_lag <= self.max_replication_lag:
+               break
+
+            logging.info("Waiting for replication lag to drop below %d seconds, current lag: %s" % (self.max_replication_lag, str(replication_lag)))
+            time.sleep(REPLICATION_POLL_SECONDS)
+
+   def get_replication_lag(self):
+
+      with self.replica_lock:
+
+         with closing(self.replica_conn.cursor()) as cur:
+
+            cur.execute('SHOW SLAVE STATUS')
+            row = cur.fetchone()
+
+            if not row:
+               raise RuntimeError('No replication status found on replica host!')
+
+            columns = [column[0] for column in cur.description]
+
+            # None if replication is not running.
+            return row[columns.index('Seconds_Behind_Master')]
+
+
+class Checkpoint:
+
+   def __init__(self, path, retry_failed):
+
+      self.lock = threading.Lock()
+      self.retry_failed = retry_failed
+
+      # Last written status of each uid/gid pair.
+      self.status_map = dict()
+
+      self.file = None
+
+      if not path:
+         return
+
+      is_line_open = False
+
+      if os.path.isfile(path):
+
+         with open(path, 'r') as f:
+
+            for line in f:
+
+               is_line_open = not line.endswith('\n')
+
+               fields = line.strip().split(';')
+
+               # A partially written last line of an interrupted run is ignored.
+               if len(fields) == 3 and fields[2] in STATUS_LIST:
+                  self.status_map[(fields[0], fields[1])] = fields[2]
+
+         logging.info("Loaded checkpoint file with %d uid/gid pairs: %s" % (len(self.status_map), path))
+
+      self.file = open(path, 'a')
+
+      if is_line_open:
+         self.file.write('\n')
+
+   def close(self):
+
+      if self.file:
+         self.file.close()
+
+   def get_status(self, uid, gid):
+      return self.status_map.get((uid, gid))
+
+   def is_done(self, uid, gid):
+
+      status = self.get_status(uid, gid)
+
+      # Rolled back and partial pairs are retried on restart, failed pairs need manual inspection unless retried explicitly.
+      if status == STATUS_FAILED:
+         return not self.retry_failed
+
+      return status == STATUS_COMPLETED
+
+   def write(self, uid, gid, status):
+
+      with self.lock:
+
+         self.status_map[(uid, gid)] = status
+
+         if self.file:
+            self.file.write("%s;%s;%s\n" % (uid, gid, status))
+            self.file.flush()
+
+
+class Progress:
+
+   def __init__(self, num_pairs, expected_rows, interval):
+
+      self.num_pairs = num_pairs
+      self.expected_rows = expected_rows
+      self.interval = interval
+
+      self.lock = threading.Lock()
+      self.start_time = time.time()
+      self.row_count = 0
+      self.status_count_map = dict([(status, 0) for status in STATUS_LIST])
+
+      self.stop_event = threading.Event()
+      self.reporter = None
+
+   def add_rows(self, rows):
+
+      with self.lock:
+         self.row_count += rows
+
+   def add_pair(self, status):
+
+      with self.lock:
+         self.status_count_map[status] += 1
+
+   def start(self):
+
+      if self.interval:
+         self.reporter = threading.Thread(target=self.report_periodically, daemon=True)
+         self.reporter.start()
+
+   def stop(self):
+
+      self.stop_event.set()
+
+      if self.reporter:
+         self.reporter.join()
+
+      self.report()
+
+   def report_periodically(self):
+
+      while not self.stop_event.wait(self.interval):
+         self.report()
+
+   def report(self):
+
+      with self.lock:
+         row_count = self.row_count
+         status_count_map = dict(self.status_count_map)
+
+      elapsed_time = time.time() - self.start_time
+
+      rows_per_second = 0
+
+      if elapsed_time > 0:
+         rows_per_second = row_count / elapsed_time
+
+      # The expected rows are the ENTRIES pre-counts of the pending pairs.
+      eta = 'unknown'
+
+      if rows_per_second > 0:
+         eta = "%ds" % (max(self.expected_rows - row_count, 0) / rows_per_second)
+
+      logging.info("Progress - pairs done: %d/%d (completed: %d, rolled back: %d, partial: %d, failed: %d) - rows: %d/%d - rows/s: %.1f - ETA: %s"
+                   % (sum(status_count_map.values()), self.num_pairs,
+                      status_count_map[STATUS_COMPLETED], status_count_map[STATUS_ROLLED_BACK], status_count_map[STATUS_PARTIAL], status_count_map[STATUS_FAILED],
+                      row_count, self.expected_rows, rows_per_second, eta))
+
+
+class PreCount:
+
+   def __init__(self, cur):
+
+      # Rows of all numeric uid/gid pairs are counted with one grouped query per table instead of per pair.
+      self.entries_count_map = get_grouped_count_map(cur, 'ENTRIES')
+      self.acct_stat_count_map = get_grouped_count_map(cur, 'ACCT_STAT')
+
+   def get_entries_count(self, uid, gid):
+      return self.entries_count_map.get((uid, gid), 0)
+
+   def get_acct_stat_count(self, uid, gid):
+      return self.acct_stat_count_map.get((uid, gid), 0)
+
+   def get_mapped_entries_count(self, resolved_uid_gid_list):
+      return self._get_mapped_count(self.entries_count_map, resolved_uid_gid_list)
+
+   def get_mapped_acct_stat_count(self, resolved_uid_gid_list):
+      return self._get_mapped_count(self.acct_stat_count_map, resolved_uid_gid_list)
+
+   def _get_mapped_count(self, count_map, resolved_uid_gid_list):
+      return sum([count_map.get((tup[0], tup[1]), 0) for tup in resolved_uid_gid_list])
+
+
+class ConcurrencyController:
+
+   def __init__(self, min_workers, max_workers, target_latency, max_rollback_rate, interval):
+
+      if min_workers < 1 or min_workers > max_workers:
+         raise RuntimeError('Minimum parallel updates must be between 1 and the number of parallel updates!')
+
+      self.min_workers = min_workers
+      self.max_workers = max_workers
+      self.target_latency = target_latency
+      self.max_rollback_rate = max_rollback_rate
+      self.interval = interval
+
+      # Starts low and grows while the database keeps up.
+      self.limit = min_workers
+      self.active = 0
+
+      self.condition = threading.Condition()
+
+      self.reset_window()
+
+   def reset_window(self):
+
+      self.window_start_time = time.time()
+      self.statement_count = 0
+      self.latency_sum = 0.0
+      self.lock_error_count = 0
+      self.pair_count = 0
+      self.rollback_count = 0
+
+   def acquire(self):
+
+      with self.condition:
+
+         while self.active >= self.limit:
+            self.condition.wait()
+
+         self.active += 1
+
+   def release(self):
+
+      with self.condition:
+         self.active -= 1
+         self.condition.notify_all()
+
+   def record_statement(self, latency):
+
+      with self.condition:
+         self.statement_count += 1
+         self.latency_sum += latency
+         self.adjust()
+
+   def record_lock_error(self):
+
+      with self.condition:
+         self.lock_error_count += 1
+         self.adjust()
+
+   def record_pair(self, status):
+
+      with self.condition:
+
+         self.pair_count += 1
+
+         if status != STATUS_COMPLETED:
+            self.rollback_count += 1
+
+         self.adjust()
+
+   def adjust(self):
+      """Increases the limit by one if the database keeps up, otherwise halves it (must be called with the condition held)."""
+
+      if self.min_workers == self.max_workers:
+         return
+
+      if time.time() - self.window_start_time < self.interval:
+         return
+
+      latency = 0.0
+
+      if self.statement_count:
+         latency = self.latency_sum / self.statement_count
+
+      rollback_rate = 0.0
+
+      if self.pair_count:
+         rollback_rate = self.rollback_count / self.pair_count
+
+      limit = self.limit
+
+      if self.lock_error_count or rollback_rate > self.max_rollback_rate or latency > self.target_latency:
+         limit = max(self.min_workers, self.limit // 2)
+      elif self.statement_count or self.pair_count:
+         limit = min(self.max_workers, self.limit + 1)
+
+      if limit != self.limit:
+
+         logging.info("Changed parallel updates from %d to %d - statement latency: %.3fs - lock errors: %d - rollback rate: %.2f"
+                      % (self.limit, limit, latency, self.lock_error_count, rollback_rate))
+
+         self.limit = limit
+         self.condition.notify_all()
+
+      self.reset_window()
+
 
 class WorkerThread(threading.Thread):
 
-   def __init__(self, uid, gid, host, username, password, database):
+   def __init__(self, task_queue, chunk_size, throttle, controller, progress, checkpoint, host, username, password, database):
 
       threading.Thread.__init__(self)
 
-      self.uid = uid
-      self.gid = gid
-      self.name = str(uid) + ":" + str(gid)
+      self.task_queue = task_queue
+      self.chunk_size = chunk_size
+      self.throttle = throttle
+      self.controller = controller
+      self.progress = progress
+      self.checkpoint = checkpoint
 
       self.host = host
       self.username = username
@@ -54,21 +468,224 @@ class WorkerThread(threading.Thread):
 
       logging.debug("Thread '%s' started!" % self.name)
 
-      self.cleanup()
+      try:
+
+         # One connection per worker is reused for all uid/gid pairs taken from the task queue.
+         with closing(MySQLdb.connect(host=self.host, user=self.username, passwd=self.password, db=self.database)) as conn:
+
+            with closing(conn.cursor()) as cur:
+
+               sql = "SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED;"
+               logging.debug(sql)
+               cur.execute(sql)
+
+               while True:
+
+                  task = self.task_queue.get()
+
+                  if task is None:
+                     break
+
+                  uid, gid = task[0], task[1]
+
+                  status = self.cleanup(cur, *task)
+
+                  self.controller.record_pair(status)
+
+                  self.checkpoint.write(uid, gid, status)
+                  self.progress.add_pair(status)
+
+      except Exception as e:
+         logging.error("Cought exception in thread ('%s') with error message:\n%s" % (self.name, str(e)))
 
       logging.debug("Thread '%s' finished!" % self.name)
 
-   def cleanup(self):
+   def cleanup(self, cur, uid, gid, user, group, pre_count_acct_stat, pre_count_entries):
+      """Returns the checkpoint status of the uid/gid pair.
+
+      The pre-counts are taken at start, rows added since then let the count check fail and the pair is retried by a restarted run.
+      """
+
+      name = str(uid) + ":" + str(gid)
+
+      # Rows of the pair in chunks committed so far.
+      self.committed_row_count = 0
 
       try:
 
-         uid = self.uid
-         gid = self.gid
+         logging.debug("Thread '%s' processing: %s - expected rows in ACCT_STAT: %d - ENTRIES: %d" % (self.name, name, pre_count_acct_stat, pre_count_entries))
+
+         post_count_entries = None
+
+         if self.chunk_size:
+
+            post_count_entries = self.update_entries_chunked(cur, uid, gid, user, group)
+
+            if pre_count_entries != post_count_entries:
+               logging.error("Updated %d of %d expected rows in ENTRIES in chunks for '%s', ACCT_STAT is not cleaned up." % (post_count_entries, pre_count_entries, name))
+               # Already committed chunks are kept, a retry updates the remaining rows and cleans up ACCT_STAT.
+               return STATUS_PARTIAL
+
+         # Workers above the current concurrency limit wait here before the transaction of the pair,
+         # in chunked mode each chunk has taken a slot on its own before.
+         self.controller.acquire()
+
+         try:
+            status, post_count_entries = self.cleanup_transaction(cur, uid, gid, user, group, pre_count_acct_stat, pre_count_entries, post_count_entries)
+         finally:
+            self.controller.release()
+
+         # Waiting after the transaction has ended keeps row locks short and lets the replicas catch up on committed rows.
+         if not self.chunk_size:
+            self.throttle.wait(post_count_entries)
+
+         return status
+
+      except Exception as e:
+
+         logging.error("Cought exception during cleanup of '%s' in thread ('%s') with error message:\n%s" % (name, self.name, str(e)))
+
+         # The connection is reused for the next pair, so an open transaction must not be left behind.
+         cur.execute('ROLLBACK')
+
+         if self.committed_row_count:
+            logging.error("Kept %d rows of committed chunks in ENTRIES for '%s'." % (self.committed_row_count, name))
+
+         # Lock conflicts are transient, so the pair is retried by a restarted run.
+         if isinstance(e, MySQLdb.OperationalError) and e.args and e.args[0] in LOCK_ERROR_CODES:
+
+            self.controller.record_lock_error()
+
+            if self.committed_row_count:
+               return STATUS_PARTIAL
+
+            return STATUS_ROLLED_BACK
+
+         return STATUS_FAILED
+
+   def cleanup_transaction(self, cur, uid, gid, user, group, pre_count_acct_stat, pre_count_entries, post_count_entries):
+      """Updates ENTRIES unless already done in chunks and deletes ACCT_STAT in one transaction, returns the status and the updated ENTRIES rows."""
+
+      do_rollback = False
+
+      cur.execute('BEGIN')
+
+      if not self.chunk_size:
+
+         # The latency of a whole pair grows with its row count, so it is not recorded for adaptive concurrency.
+         sql = "UPDATE ENTRIES SET uid = '" + user + "', gid = '" + group + "' WHERE uid = '" + uid + "' AND gid = '" + gid + "'"
+         cur.execute(sql)
+         post_count_entries = cur.rowcount
+         logging.debug(sql + ": " + str(post_count_entries))
+
+         self.progress.add_rows(post_count_entries)
+
+      if pre_count_entries == post_count_entries:
+
+         sql = "DELETE FROM ACCT_STAT WHERE uid = '" + uid + "' AND gid = '" + gid + "';"
+         cur.execute(sql)
+         post_count_acct_stat = cur.rowcount
+         logging.debug(sql + ": " + str(post_count_acct_stat))
+
+         if pre_count_acct_stat == post_count_acct_stat:
+            cur.execute('COMMIT')
+            logging.debug('COMMITED')
+         else:
+            do_rollback = True
+
+      else:
+         do_rollback = True
+
+      status = STATUS_COMPLETED
+
+      if do_rollback == True:
+         cur.execute('ROLLBACK')
+         logging.debug('ROLLBACK')
+
+         status = STATUS_ROLLED_BACK
+
+      return status, post_count_entries
 
-         user = pwd.getpwuid(int(uid)).pw_name
-         group = grp.getgrgid(int(gid)).gr_name
+   def update_entries_chunked(self, cur, uid, gid, user, group):
 
-         do_rollback = False
+      # Each chunk ends at the id of its last row and the next one continues after it,
+      # so rows already scanned are not read again without an index on uid and gid.
+      lower_condition = ""
+      lower_params = ()
+
+      post_count_entries = 0
+
+      while True:
+
+         # The concurrency slot is taken per chunk, so a limit change takes effect within a large pair.
+         self.controller.acquire()
+
+         try:
+
+            sql = "SELECT id FROM ENTRIES WHERE uid = %s AND gid = %s" + lower_condition + " ORDER BY id LIMIT 1 OFFSET %s"
+            cur.execute(sql, (uid, gid) + lower_params + (self.chunk_size - 1,))
+            row = cur.fetchone()
+
+            upper_condition = ""
+            upper_params = ()
+
+            if row:
+               upper_condition = " AND id <= %s"
+               upper_params = (row[0],)
+
+            sql = "UPDATE ENTRIES SET uid = %s, gid = %s WHERE uid = %s AND gid = %s" + lower_condition + upper_condition
+            params = (user, group, uid, gid) + lower_params + upper_params
+
+            start_time = time.time()
+            cur.execute('BEGIN')
+            cur.execute(sql, params)
+            chunk_count = cur.rowcount
+            cur.execute('COMMIT')
+            self.controller.record_statement(time.time() - start_time)
+
+         finally:
+            self.controller.release()
+
+         post_count_entries += chunk_count
+         self.committed_row_count += chunk_count
+         logging.debug("%s %s: %d - total: %d" % (sql, str(params), chunk_count, post_count_entries))
+
+         self.progress.add_rows(chunk_count)
+         self.throttle.wait(chunk_count)
+
+         if not row:
+            break
+
+         lower_condition = " AND id > %s"
+         lower_params = (row[0],)
+
+      return post_count_entries
+
+
+class RangeWorkerThread(threading.Thread):
+
+   def __init__(self, range_queue, resolved_uid_gid_list, throttle, controller, progress, host, username, password, database):
+
+      threading.Thread.__init__(self)
+
+      self.range_queue = range_queue
+      self.resolved_uid_gid_list = resolved_uid_gid_list
+      self.throttle = throttle
+      self.controller = controller
+      self.progress = progress
+
+      self.host = host
+      self.username = username
+      self.password = password
+      self.database = database
+
+      self.row_count = 0
+
+   def run(self):
+
+      logging.debug("Thread '%s' started!" % self.name)
+
+      try:
 
          with closing(MySQLdb.connect(host=self.host, user=self.username, passwd=self.password, db=self.database)) as conn:
 
@@ -78,45 +695,50 @@ class WorkerThread(threading.Thread):
                logging.debug(sql)
                cur.execute(sql)
 
-               sql = "SELECT COUNT(*) FROM ACCT_STAT WHERE uid = '" + uid + "' AND gid = '" + gid + "';"
-               cur.execute(sql)
-               pre_count_acct_stat = int(cur.fetchone()[0])
-               logging.debug(sql + ": " +str(pre_count_acct_stat))
+               # Temporary tables are only visible to the connection that created them.
+               create_mapping_table(cur, self.resolved_uid_gid_list)
 
-               sql = "SELECT COUNT(*) FROM ENTRIES WHERE uid = '" + uid + "' AND gid = '" + gid + "'"
-               cur.execute(sql)
-               pre_count_entries = int(cur.fetchone()[0])
-               logging.debug(sql + ": " + str(pre_count_entries))
+               while True:
 
-               cur.execute('BEGIN')
+                  id_range = self.range_queue.get()
 
-               sql = "UPDATE ENTRIES SET uid = '" + user + "', gid = '" + group + "' WHERE uid = '" + uid + "' AND gid = '" + gid + "'"
-               cur.execute(sql)
-               post_count_entries = cur.rowcount
-               logging.debug(sql + ": " + str(post_count_entries))
+                  if id_range == STOP_MARKER:
+                     break
+
+                  self.controller.acquire()
+
+                  try:
+                     self.update_range(cur, id_range)
+                  finally:
+                     self.controller.release()
+
+      except Exception as e:
+         logging.error("Cought exception in thread ('%s') with error message:\n%s" % (self.name, str(e)))
+
+      logging.debug("Thread '%s' finished!" % self.name)
 
-               if pre_count_entries == post_count_entries:
+   def update_range(self, cur, id_range):
 
-                  sql = "DELETE FROM ACCT_STAT WHERE uid = '" + uid + "' AND gid = '" + gid + "';"
-                  cur.execute(sql)
-                  post_count_acct_stat = cur.rowcount
-                  logging.debug(sql + ": " + str(post_count_acct_stat))
+      try:
 
-                  if pre_count_acct_stat == post_count_acct_stat:
-                     cur.execute('COMMIT')
-                     logging.debug('COMMITED')
-                  else:
-                     do_rollback = True
+         start_time = time.time()
+         count = update_mapped_entries(cur, id_range)
+         self.controller.record_statement(time.time() - start_time)
 
-               else:
-                  do_rollback = True
+         self.row_count += count
 
-               if do_rollback == True:
-                  cur.execute('ROLLBACK')
-                  logging.debug('ROLLBACK')
+         self.progress.add_rows(count)
+         self.throttle.wait(count)
 
       except Exception as e:
-         logging.error("Cought exception during cleanup in thread ('%s') with error message:\n%s" % (self.name, str(e)))
+
+         # The missing rows are detected by the final count check and left for a restarted run.
+         logging.error("Cought exception during update of id range %s in thread ('%s') with error message:\n%s" % (str(id_range), self.name, str(e)))
+
+         cur.execute('ROLLBACK')
+
+         if isinstance(e, MySQLdb.OperationalError) and e.args and e.args[0] in LOCK_ERROR_CODES:
+            self.controller.record_lock_error()
 
 
 def get_numeric_numeric_uid_gid_list(cur):
@@ -127,49 +749,222 @@ def get_numeric_numeric_uid_gid_list(cur):
 
    numeric_uid_gid_list = []
 
+   # Both columns are VARBINARY and returned as bytes.
    for row in cur.fetchall():
-      tup = (row[0], row[1])
+      tup = (decode_column(row[0]), decode_column(row[1]))
       numeric_uid_gid_list.append(tup)
 
    logging.debug("Found: %d" % len(numeric_uid_gid_list))
 
    return numeric_uid_gid_list
 
-def cleanup_database(numeric_uid_gid_list, parallel_updates, host, username, password, database):
+def get_grouped_count_map(cur, table):
+
+   sql = "SELECT uid, gid, COUNT(*) FROM " + table + " WHERE uid REGEXP '^[0-9]+$' AND gid REGEXP '^[0-9]+$' GROUP BY uid, gid"
+   cur.execute(sql)
+
+   count_map = dict([((decode_column(row[0]), decode_column(row[1])), int(row[2])) for row in cur.fetchall()])
+   logging.debug(sql + ": " + str(len(count_map)))
+
+   return count_map
+
+def resolve_uid_gid_list(id_resolver, numeric_uid_gid_list):
+
+   resolved_uid_gid_list = list()
+
+   for uid, gid in numeric_uid_gid_list:
+
+      user = id_resolver.get_user(uid)
+      group = id_resolver.get_group(gid)
+
+      if user and group:
+         resolved_uid_gid_list.append((uid, gid, user, group))
+
+   unresolved_uid_list = id_resolver.get_unresolved_uid_list()
+   unresolved_gid_list = id_resolver.get_unresolved_gid_list()
+
+   # Reported before any update is done on the database.
+   if unresolved_uid_list or unresolved_gid_list:
+
+      logging.warning("Unresolvable uids (%d): %s" % (len(unresolved_uid_list), ', '.join([str(uid) for uid in unresolved_uid_list])))
+      logging.warning("Unresolvable gids (%d): %s" % (len(unresolved_gid_list), ', '.join([str(gid) for gid in unresolved_gid_list])))
+
+   logging.info("Resolved uid/gid pairs: %d - Skipped unresolvable uid/gid pairs: %d" % (len(resolved_uid_gid_list), len(numeric_uid_gid_list) - len(resolved_uid_gid_list)))
+
+   return resolved_uid_gid_list
+
+def create_mapping_table(cur, resolved_uid_gid_list):
+   """Creates the temporary PAIR_MAPPING table with the names of each resolved uid/gid pair."""
+
+   sql = "CREATE TEMPORARY TABLE PAIR_MAPPING (uid VARBINARY(127) NOT NULL, gid VARBINARY(127) NOT NULL, uid_name VARBINARY(127) NOT NULL, gid_name VARBINARY(127) NOT NULL, PRIMARY KEY (uid, gid))"
+   logging.debug(sql)
+   cur.execute(sql)
+
+   sql = "INSERT INTO PAIR_MAPPING (uid, gid, uid_name, gid_name) VALUES (%s, %s, %s, %s)"
+   logging.debug(sql)
+   cur.executemany(sql, list(resolved_uid_gid_list))
+
+def update_mapped_entries(cur, id_range):
+   """Translates all mapped uid/gid pairs in one transaction, restricted to the id range if set."""
+
+   sql = "UPDATE " + MAPPING_JOIN + " SET e.uid = pm.uid_name, e.gid = pm.gid_name"
+   params = ()
+
+   if id_range:
+      condition, params = get_id_range_condition(id_range[0], id_range[1], 'e.id')
+      sql += " WHERE " + condition
+
+   cur.execute('BEGIN')
+   cur.execute(sql, params)
+   count = cur.rowcount
+   cur.execute('COMMIT')
+
+   logging.debug("%s %s: %d" % (sql, str(params), count))
+
+   return count
+
+def finish_cleanup_set_based(cur, resolved_uid_gid_list, pre_count, post_count_entries, progress, checkpoint):
+
+   pre_count_entries = pre_count.get_mapped_entries_count(resolved_uid_gid_list)
+
+   status = STATUS_ROLLED_BACK
+
+   if pre_count_entries != post_count_entries:
+
+      logging.error("Updated %d of %d expected rows in ENTRIES, ACCT_STAT is not cleaned up." % (post_count_entries, pre_count_entries))
+
+      # Each UPDATE is committed on its own, so updated rows are kept.
+      if post_count_entries:
+         status = STATUS_PARTIAL
+
+   else:
+
+      pre_count_acct_stat = pre_count.get_mapped_acct_stat_count(resolved_uid_gid_list)
+
+      sql = "DELETE a FROM ACCT_STAT a JOIN PAIR_MAPPING pm ON a.uid = pm.uid AND a.gid = pm.gid"
+      cur.execute('BEGIN')
+      cur.execute(sql)
+      post_count_acct_stat = cur.rowcount
+      logging.debug(sql + ": " + str(post_count_acct_stat))
+
+      if pre_count_acct_stat == post_count_acct_stat:
+         cur.execute('COMMIT')
+         status = STATUS_COMPLETED
+      else:
+         cur.execute('ROLLBACK')
+         logging.error("Deleted %d of %d expected rows in ACCT_STAT, ACCT_STAT is not cleaned up." % (post_count_acct_stat, pre_count_acct_stat))
+
+   # All pairs are translated together, so they share one checkpoint status.
+   for tup in resolved_uid_gid_list:
+      checkpoint.write(tup[0], tup[1], status)
+      progress.add_pair(status)
+
+   if status == STATUS_COMPLETED:
+      logging.info("Updated rows in ENTRIES: %d" % post_count_entries)
+
+def cleanup_database_set_based(cur, resolved_uid_gid_list, pre_count, chunk_size, throttle, progress, checkpoint):
+
+   if not resolved_uid_gid_list:
+      logging.info('No resolvable uid/gid pairs found.')
+      return
+
+   create_mapping_table(cur, resolved_uid_gid_list)
+
+   if chunk_size:
+      id_range_list = iter_id_ranges(cur, chunk_size)
+   else:
+      id_range_list = [None]
+
+   post_count_entries = 0
+
+   # One joined UPDATE per id range translates all uid/gid pairs, so ENTRIES is scanned only once.
+   for id_range in id_range_list:
+
+      chunk_count = update_mapped_entries(cur, id_range)
+      post_count_entries += chunk_count
+
+      progress.add_rows(chunk_count)
+      throttle.wait(chunk_count)
+
+   finish_cleanup_set_based(cur, resolved_uid_gid_list, pre_count, post_count_entries, progress, checkpoint)
+
+def cleanup_database_id_ranges(cur, resolved_uid_gid_list, pre_count, controller, chunk_size, throttle, progress, checkpoint, host, username, password, database):
+
+   if not resolved_uid_gid_list:
+      logging.info('No resolvable uid/gid pairs found.')
+      return
+
+   create_mapping_table(cur, resolved_uid_gid_list)
+
+   range_size = chunk_size
+
+   # Enough ranges per worker for the load to stay even when ranges differ in the number of matching rows.
+   if not range_size:
+      range_size = -(-get_estimated_row_count(cur) // (controller.max_workers * RANGES_PER_WORKER))
+
+   range_queue = queue.Queue()
 
-   thread_counter = 0
    thread_handles = list()
 
-   try:
+   for i in range(controller.max_workers):
+
+      th_handle = RangeWorkerThread(range_queue, resolved_uid_gid_list, throttle, controller, progress, host, username, password, database)
+      th_handle.start()
+
+      thread_handles.append(th_handle)
+
+   # Workers start on the first ranges while the next range boundaries are read.
+   if range_size:
+
+      logging.debug("Partitioning ENTRIES in id ranges of %d rows" % range_size)
+
+      for id_range in iter_id_ranges(cur, range_size):
+         range_queue.put(id_range)
+
+   else:
+      range_queue.put(None)
 
-      for tup in numeric_uid_gid_list:
+   for th_handle in thread_handles:
+      range_queue.put(STOP_MARKER)
 
-         th_handle = WorkerThread(tup[0], tup[1], host, username, password, database)
-         th_handle.start()
+   post_count_entries = 0
 
-         thread_handles.append(th_handle)
+   for th_handle in thread_handles:
 
-         thread_counter += 1
+      logging.debug("Joining thread: '%s'" % th_handle.name)
 
-         if thread_counter == parallel_updates:
+      th_handle.join()
 
-            for th_handle in thread_handles:
+      post_count_entries += th_handle.row_count
 
-               logging.info("Joining thread: '%s'" % th_handle.name)
+   finish_cleanup_set_based(cur, resolved_uid_gid_list, pre_count, post_count_entries, progress, checkpoint)
 
-               th_handle.join()
+def cleanup_database(resolved_uid_gid_list, pre_count, controller, chunk_size, throttle, progress, checkpoint, host, username, password, database):
 
-            thread_handles = list()
-            thread_counter = 0
+   task_queue = queue.Queue()
 
-      for th_handle in thread_handles:
+   for uid, gid, user, group in resolved_uid_gid_list:
+      task_queue.put((uid, gid, user, group, pre_count.get_acct_stat_count(uid, gid), pre_count.get_entries_count(uid, gid)))
 
-         logging.debug("Joining thread: '%s'" % th_handle.name)
+   # A fixed pool of long-lived workers drains the shared queue, one stop marker per worker.
+   for i in range(controller.max_workers):
+      task_queue.put(None)
 
-         th_handle.join()
+   thread_handles = list()
+
+   # All workers are started up front, the controller limits how many of them are updating at a time.
+   for i in range(controller.max_workers):
+
+      th_handle = WorkerThread(task_queue, chunk_size, throttle, controller, progress, checkpoint, host, username, password, database)
+      th_handle.start()
+
+      thread_handles.append(th_handle)
+
+   for th_handle in thread_handles:
+
+      logging.debug("Joining thread: '%s'" % th_handle.name)
 
-   except Exception as e:
-      logging.error("Cought exception during cleanup in thread ('%s') with error message:\n%s" % (self.name, str(e)))
+      th_handle.join()
 
 def main():
 
@@ -183,17 +978,72 @@ def main():
    parser.add_argument('-p', '--password', dest='password', type=str, required=True,  help='Password for the Robinhood Database.')
    parser.add_argument('-H', '--host',     dest='host',     type=str, required=False, help='Database Host.', default=HOST)
    parser.add_argument('-d', '--database', dest='database', type=str, required=True,  help='Robinhood Database.')
-   parser.add_argument('-w', '--parallel-updates', dest='parallel_updates', type=int, required=False, help='Specifies parallel update count.', default=4)
+   parser.add_argument('-w', '--parallel-updates', dest='parallel_updates', type=int, required=False, help='Specifies parallel update count, the upper bound if adaptive concurrency is enabled.', default=4)
+   parser.add_argument('--min-parallel-updates', dest='min_parallel_updates', type=int, required=False, help='Enables adaptive concurrency between the given lower bound and the parallel update count. Default: parallel update count')
+   parser.add_argument('--target-latency', dest='target_latency', type=float, required=False, help='Average latency in seconds of chunk or id range UPDATE statements above which adaptive concurrency is reduced. Without a chunk size, uid/gid pairs are updated in one statement each and adaptive concurrency only reacts to lock errors and rollbacks.', default=1.0)
+   parser.add_argument('--max-rollback-rate', dest='max_rollback_rate', type=float, required=False, help='Ratio of not completed uid/gid pairs above which adaptive concurrency is reduced.', default=0.1)
+   parser.add_argument('--adjust-interval', dest='adjust_interval', type=int, required=False, help='Seconds between adjustments of adaptive concurrency.', default=10)
+   parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int, required=False, help='Updates ENTRIES in primary key ordered chunks of the given number of rows with a commit per chunk, 0 updates all rows of an uid/gid pair in one transaction.', default=0)
+   parser.add_argument('--max-rows-per-second', dest='max_rows_per_second', type=float, required=False, help='Limits the number of updated ENTRIES rows per second of all workers, 0 for no limit.', default=0)
+   parser.add_argument('--max-replication-lag', dest='max_replication_lag', type=int, required=False, help='Pauses updates while the replication lag of the replica host exceeds the given seconds, 0 for no limit.', default=0)
+   parser.add_argument('--set-based', dest='set_based', required=False, action='store_true', help='Translates all uid/gid pairs at once by joining ENTRIES on uid and gid with a temporary mapping table of the pairs, per id range chunk if a chunk size is set.')
+   parser.add_argument('--id-ranges', dest='id_ranges', required=False, action='store_true', help='Like --set-based, but partitions ENTRIES in primary key ranges that are updated by the parallel workers, ranges are of chunk size rows if set or else sized from the table statistics.')
+   parser.add_argument('--no-preload-ids', dest='no_preload_ids', required=False, action='store_true', help='Disables loading the complete passwd and group databases at start, ids are then looked up one by one and cached.')
+   parser.add_argument('--replica-host', dest='replica_host', type=str, required=False, help='Replica database host for checking the replication lag.')
+   parser.add_argument('--checkpoint-file', dest='checkpoint_file', type=str, required=False, help='Records the status of processed uid/gid pairs, a restarted run skips completed and failed pairs and retries rolled back and partially updated pairs.')
+   parser.add_argument('--retry-failed', dest='retry_failed', required=False, action='store_true', help='Retries uid/gid pairs recorded as failed in the checkpoint file.')
+   parser.add_argument('--progress-interval', dest='progress_interval', type=int, required=False, help='Seconds between progress reports, 0 reports only at the end.', default=60)
 
    args = parser.parse_args()
 
+   if args.max_replication_lag and not args.replica_host:
+      raise RuntimeError('Replica host must be set for checking the replication lag!')
+
+   min_parallel_updates = args.min_parallel_updates
+
+   if min_parallel_updates is None:
+      min_parallel_updates = args.parallel_updates
+
+   controller = ConcurrencyController(min_parallel_updates, args.parallel_updates, args.target_latency, args.max_rollback_rate, args.adjust_interval)
+
    with closing(MySQLdb.connect(host=args.host, user=args.username, passwd=args.password, db=args.database)) as conn:
 
       with closing(conn.cursor()) as cur:
 
          numeric_uid_gid_list = get_numeric_numeric_uid_gid_list(cur)
 
-         cleanup_database(numeric_uid_gid_list, args.parallel_updates, args.host, args.username, args.password, args.database)
+         resolved_uid_gid_list = resolve_uid_gid_list(IdResolver(not args.no_preload_ids), numeric_uid_gid_list)
+
+         checkpoint = Checkpoint(args.checkpoint_file, args.retry_failed)
+
+         pending_uid_gid_list = [tup for tup in resolved_uid_gid_list if not checkpoint.is_done(tup[0], tup[1])]
+
+         if len(pending_uid_gid_list) < len(resolved_uid_gid_list):
+            logging.info("Resuming from checkpoint - skipped uid/gid pairs: %d - pending uid/gid pairs: %d" % (len(resolved_uid_gid_list) - len(pending_uid_gid_list), len(pending_uid_gid_list)))
+
+         pre_count = PreCount(cur)
+
+         expected_rows = sum([pre_count.get_entries_count(tup[0], tup[1]) for tup in pending_uid_gid_list])
+
+         progress = Progress(len(pending_uid_gid_list), expected_rows, args.progress_interval)
+
+         throttle = Throttle(args.max_rows_per_second, args.max_replication_lag, args.replica_host, args.username, args.password)
+
+         try:
+
+            progress.start()
+
+            if args.id_ranges:
+               cleanup_database_id_ranges(cur, pending_uid_gid_list, pre_count, controller, args.chunk_size, throttle, progress, checkpoint, args.host, args.username, args.password, args.database)
+            elif args.set_based:
+               cleanup_database_set_based(cur, pending_uid_gid_list, pre_count, args.chunk_size, throttle, progress, checkpoint)
+            else:
+               cleanup_database(pending_uid_gid_list, pre_count, controller, args.chunk_size, throttle, progress, checkpoint, args.host, args.username, args.password, args.database)
+
+         finally:
+            progress.stop()
+            throttle.close()
+            checkpoint.close()
    
    logging.info('END')
 